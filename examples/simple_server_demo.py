@@ -16,7 +16,8 @@ def main(args : Namespace) -> RosettaRunner:
     if not isfile(args.pdb_file):
         raise FileNotFoundError(f"Could not find the PDB file: {args.pdb_file}")
 
-    with open(args.pdb_file, "r") as r:
+    # Read as bytes, which are sent to Rosetta as they are without decoding and re-encoding
+    with open(args.pdb_file, "rb") as r:
         pdb = r.read()
 
     runner = RosettaRunner(
@@ -30,10 +31,10 @@ def main(args : Namespace) -> RosettaRunner:
         raise ConnectionError(f"Cannot connect to RosettaExchange server at address: {args.ros_add} | port: {args.ros_prt}.\n"
                               f"Please check the address and port have been inputted correctly.")
 
-    # Send the pose to RosettaExchange then recieve a copy of the structure from Rosetta.
-    pose_name = runner.run_rosetta_command("ros/send_pose", pose_name="basic_setup_pose", pose_to_store=pdb)["pose_name"]
-    # pose_info = runner.request_pose_info(pose_name=pose_name)
-    runner._trajectory.stored_frames = [runner.request_pose(pose_name=pose_name)["pose_pdb"]]
+    # Send the pose to RosettaExchange and recieve a copy of the structure from Rosetta in the same exchange.
+    pose = runner.run_rosetta_command("ros/store_and_send_pose", pose_name="basic_setup_pose", pose_to_store=pdb)
+    # pose_info = runner.request_pose_info(pose_name=pose["pose_name"])
+    runner._trajectory.stored_frames.append(pose["pose_pdb"])
     runner._trajectory.send_current_frame()
 
     return runner
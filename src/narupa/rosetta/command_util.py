@@ -1,8 +1,16 @@
 # Copyright (c) Tim Neary, University of Bristol. Github username: TENeary, contact: tn15550@bristol.ac.uk
 # Licensed under the GPL. See License.txt in the project root for license information.
 
-from typing import Dict
-from json import loads as jloads
+from typing import Dict, Union
+try: # orjson is optional but parses the (large) serialised pose info considerably faster
+  from orjson import loads as jloads
+except ImportError:
+  from json import loads as jloads
+from concurrent.futures import Future
+from functools import lru_cache
+from types import MappingProxyType
+from weakref import WeakKeyDictionary, proxy
+import numpy as np
 
 from .rosetta_communicator import *
 
@@ -17,11 +25,19 @@ class RosettaCommand:
   This class should be overwritten and the ._execute method overloaded
   Execute return values should be as a dict
   """
+  # Commands hold no per-call state, so execute reuses one instance per (client, class)
+  _instances = WeakKeyDictionary()
+
   def __init__(self,
                client : RosettaClient,
                key : str = None):
     self._msg_key = key
     self._client = client
+    # Keys are encoded once, requests are sent and replies checked as bytes
+    key = key or ""
+    self._msg_key_bytes = key.encode("utf-8")
+    self._reply_key = f"REP_{key}".encode("utf-8")
+    self._error_key = f"ERR_{key}".encode("utf-8")
 
   @classmethod
   def execute(cls,
@@ -37,7 +53,13 @@ class RosettaCommand:
     """
     if client is None:
       raise ValueError( "Rosetta Client cannot be None" )
-    cmd = cls(client)
+    commands = RosettaCommand._instances.get(client)
+    if commands is None:
+      commands = RosettaCommand._instances[client] = {}
+    cmd = commands.get(cls)
+    if cmd is None:
+      # The cached command only holds a proxy so it does not keep the client alive
+      cmd = commands[cls] = cls(proxy(client))
     return cmd._execute( **kwargs )
 
   def _execute(self, **kwargs):
@@ -51,6 +73,40 @@ class RosettaCommand:
     """
     raise NotImplementedError( f"Use of \"{self._msg_key}\" has not been implemented yet." )
 
+  def _send_request(self,
+                    msg_data : list) -> Future:
+    """
+    Sends a request using the RosettaClient without waiting for the reply.
+    The reply should be collected with _recv_response, allowing several requests to be in flight at once.
+
+    :param msg_data: String of message data to be sent, elements may also be pre-encoded bytes
+    :return request: Future to be passed to _recv_response.
+    """
+    return self._client.send_request( [self._msg_key_bytes] + msg_data )
+
+  def _recv_response(self,
+                     request : Future) -> list:
+    """
+    Waits for the reply to a request sent with _send_request.
+    Only the return key is checked, the message data is left as bytes to be decoded as needed.
+
+    :raises ResponseTimeoutError: If the RosettaClient does not receive a reply within a specified timeout.
+    :raises KeyError: If the response from teh Rosetta server indicates the Key supplied is not recognised.
+    :raises FormatError: If the response from the Rosetta server is an error message, but the key is correctly parsed.
+    :return response: A list of bytes containing the response received from the server. The first entry will always be the return key.
+    """
+    response = self._client.wait_for_reply(request)
+    if not response:
+      raise ResponseTimeoutError( "Rosetta Server did not respond to message request in time." )
+    elif response[0] == self._reply_key:
+      return response
+    elif response[0] == KEY_ERROR:
+      raise KeyError( f"Rosetta Server did not recognise given key:\n{self._msg_key}" )
+    elif response[0] == self._error_key:
+      raise FormatError( f"Message data not formatted correctly. The error data provided was:\n{response[1].decode('utf-8')}" )
+    else:
+      raise FormatError( f"Unexpected reply key {response[0].decode('utf-8', 'replace')} in reply to {self._msg_key}." )
+
   def _send_recv_request(self,
                          msg_data : list) -> list:
     """
@@ -62,16 +118,7 @@ class RosettaCommand:
     :raises FormatError: If the response from the Rosetta server is an error message, but the key is correctly parsed.
     :return response: A list containing the response received from the server. The first entry will always be the return key.
     """
-    self._client.send_messages( [self._msg_key] + msg_data )
-    response = self._client.recv_messages()
-    if not response:
-      raise ResponseTimeoutError( "Rosetta Server did not respond to message request in time." )
-    elif response[0] == f"REP_{self._msg_key}":
-      return response
-    elif response[0] == "KEY_ERROR":
-      raise KeyError( f"Rosetta Server did not recognise given key:\n{self._msg_key}" )
-    elif response[0] == f"ERR_{self._msg_key}":
-      raise FormatError( f"Message data not formatted correctly. The error data provided was:\n{response[1]}" )
+    return [ frame.decode("utf-8") for frame in self._recv_response( self._send_request( msg_data ) ) ]
 
   def _var_not_none(self, var):
     """
@@ -84,6 +131,7 @@ class RosettaCommand:
       raise ValueError( f"In {self.__class__.__name__}: {var} is None... Aborting command call." )
 
   @classmethod
+  @lru_cache(maxsize=None) # Annotations are fixed per class, so the string is built once for each
   def func_signature(cls) -> str:
     annot_str = f"Arguments:\n"
     for ak, av in cls._execute.__annotations__.items():
@@ -91,6 +139,23 @@ class RosettaCommand:
     annot_str += f"Returns:\n\t{cls._execute.__annotations__['return']}"
     return annot_str
 
+  @classmethod
+  @lru_cache(maxsize=None)
+  def _func_annotations(cls) -> MappingProxyType:
+    """
+    The _execute annotations of the class as strings, read only as it is shared between callers.
+    """
+    return MappingProxyType({ ak : str(av) for ak, av in cls._execute.__annotations__.items() })
+
+  @classmethod
+  def func_annotations(cls) -> Dict[str, str]:
+    """
+    Gets the keyword arguments and return value of _execute and their types, as strings.
+
+    :return Dict { kw_arg : arg_type, ..., return : return_type }: New dict which can be modified by the caller.
+    """
+    return dict(cls._func_annotations())
+
 
   ################################################################
   ############  Common Derived Class implementations  ############
@@ -129,6 +194,7 @@ class SendPose(RosettaCommand):
   """
   Sends a pose to Rosetta, no error checking is made to ensure the Pose is
   properly formatted etc. This is the users responsibility
+  The pose can be given as bytes (e.g. a pdb file read in binary mode), which are sent without re-encoding
   Rosetta will reply with the identifier it has assigned to the Pose
   """
   def __init__(self,
@@ -137,13 +203,32 @@ class SendPose(RosettaCommand):
 
   def _execute(self,
                pose_name : str,
-               pose_to_store : str) -> Dict[str, str]:
+               pose_to_store : Union[str, bytes]) -> Dict[str, str]:
     self._var_not_none( pose_to_store )
     response = self._send_recv_request( [pose_name, pose_to_store] )
     return {"pose_name" : response[1]}
 
   ################################################################
 
+class StoreAndSendPose(RosettaCommand):
+  """
+  Sends a pose to Rosetta and requests the stored pose back in a single exchange.
+  Rosetta will reply with the identifier it has assigned to the Pose followed by the
+  pdb of the stored Pose given as a string
+  """
+  def __init__(self,
+               client : RosettaClient):
+    super().__init__( client=client, key="STORE_POSE_ECHO" )
+
+  def _execute(self,
+               pose_name : str,
+               pose_to_store : Union[str, bytes]) -> Dict[str, str]:
+    self._var_not_none( pose_to_store )
+    response = self._send_recv_request( [pose_name, pose_to_store] )
+    return {"pose_name" : response[1], "pose_pdb" : response[2]}
+
+  ################################################################
+
 class RequestPose(RosettaCommand):
   """
   Requests a pose from Rosetta.
@@ -155,9 +240,44 @@ class RequestPose(RosettaCommand):
 
   def _execute(self,
                pose_name : str = "pose0") -> Dict[str, str]:
+    return self.collect( self.submit( pose_name ) )
+
+  def submit(self,
+             pose_name : str = "pose0") -> Future:
+    """
+    Sends the pose request without waiting for the reply, so that the next pose can be requested
+    while the previous one is still being processed. The reply should be collected with collect.
+    """
     self._var_not_none(pose_name)
-    pose = self._send_recv_request([pose_name])
-    return {"pose_pdb" : pose[1]}
+    return self._send_request( [pose_name] )
+
+  def collect(self,
+              request : Future) -> Dict[str, str]:
+    """
+    Waits for the reply to a request sent with submit.
+    """
+    pose = self._recv_response( request )
+    # Only the pdb is decoded, pdbs are ascii so this takes the fast path of the utf-8 decoder
+    return {"pose_pdb" : pose[1].decode("utf-8")}
+
+  ################################################################
+
+class RequestPoseBatch(RosettaCommand):
+  """
+  Requests several poses from Rosetta in a single request.
+  Rosetta will reply with the pdb of each pose, given as a string, in the order requested
+  """
+  def __init__(self,
+               client : RosettaClient):
+    super().__init__(client=client, key="SEND_POSE_BATCH")
+
+  def _execute(self,
+               pose_names : list = None) -> Dict[str, str]:
+    self._var_not_none(pose_names)
+    poses = self._recv_response( self._send_request( list(pose_names) ) )
+    if len(poses) - 1 != len(pose_names):
+      raise FormatError( f"Requested {len(pose_names)} poses but Rosetta replied with {len(poses) - 1}." )
+    return { name : pdb.decode("utf-8") for name, pdb in zip(pose_names, poses[1:]) }
 
   ################################################################
 
@@ -176,13 +296,38 @@ class RequestPoseInfo(RosettaCommand):
   def _execute(self,
                pose_name : str = "pose0") -> Dict[str, str]:
     self._var_not_none(pose_name)
-    pose_info = self._send_recv_request( [pose_name] )
+    pose_info = self._recv_response( self._send_request( [pose_name] ) )
     # Recieves a serialised json containing the following fields:
     #   atom_coords, atom_elements, atom_bonds
     return jloads(pose_info[1])
 
   ################################################################
 
+class RequestPoseInfoBinary(RosettaCommand):
+  """
+  Requests the full pose information from Rosetta as raw little endian buffers rather than json:
+    atom_coords - float32, shape (N, 3)
+    atom_elements - uint8 atomic numbers, shape (N,)
+    atom_bonds - int32 zero indexed bond pairs with each bond listed once, shape (M, 2)
+    atom_residues - int32, shape (N,)
+  This will be returned as Dict using the above strings as keys, each entry being a read only numpy array.
+  Not all Rosetta servers support this command, see RosettaClient.binary_pose_info
+  """
+  def __init__(self,
+               client : RosettaClient):
+    super().__init__(client=client, key="SEND_POSE_INFO_BIN")
+
+  def _execute(self,
+               pose_name : str = "pose0") -> Dict[str, np.ndarray]:
+    self._var_not_none(pose_name)
+    pose_info = self._recv_response( self._send_request( [pose_name] ) )
+    return { "atom_coords" : np.frombuffer(pose_info[1], dtype="<f4").reshape(-1, 3),
+             "atom_elements" : np.frombuffer(pose_info[2], dtype="u1"),
+             "atom_bonds" : np.frombuffer(pose_info[3], dtype="<i4").reshape(-1, 2),
+             "atom_residues" : np.frombuffer(pose_info[4], dtype="<i4") }
+
+  ################################################################
+
 class RequestPoseList(RosettaCommand):
   """
   Requests a list of the stored poses
@@ -1,6 +1,8 @@
 # Copyright (c) Tim Neary, University of Bristol. Github username: TENeary, contact: tn15550@bristol.ac.uk
 # Licensed under the GPL. See License.txt in the project root for license information.
 
+import numpy as np
+
 ATOM_IDS = { # Taken from narupa.mdanalysis.converter ELEMENT_INDEX but all string entries are fully captalised
     'H' : 1,
     'HE': 2,
@@ -217,3 +219,23 @@ RES_LINKAGES = { # Correspond to the 20 standard AAs
 } # Rosetta writes backbone heavy atoms first, then R group heavy atoms then H
 
 
+# Array forms of the above, converted once at import so bonds can be built without per residue conversions
+RES3_INFO_NATOMS = { res : info[0] for res, info in RES3_INFO.items() }
+RES_LINKAGES_NP = { res : np.asarray(links, dtype=np.int32) for res, links in RES_LINKAGES.items() }
+RES_LINKAGES_LEN = { res : len(links) for res, links in RES_LINKAGES.items() }
+
+
+def _element_key(symbol : bytes) -> int:
+  """
+  Packs a (space padded) two character element symbol into a 10 bit key. Spaces map to 0 and case is ignored.
+  Other characters alias onto letters, so symbols should be checked to only contain letters and spaces first.
+  """
+  return ((symbol[0] & 0x1f) << 5) | (symbol[1] & 0x1f)
+
+# Lookup table from packed element symbols (see _element_key) to atomic number, 0 corresponds to unknown symbols.
+# Single character symbols are stored both right (as per the pdb format) and left justified.
+ATOM_ID_LUT = np.zeros(1 << 10, dtype=np.int8)
+for _symbol, _atom_id in ATOM_IDS.items():
+  ATOM_ID_LUT[_element_key(_symbol.rjust(2).encode())] = _atom_id
+  ATOM_ID_LUT[_element_key(_symbol.ljust(2).encode())] = _atom_id
+del _symbol, _atom_id
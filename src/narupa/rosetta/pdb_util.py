@@ -2,27 +2,35 @@
 # Licensed under the GPL. See License.txt in the project root for license information.
 
 from narupa.trajectory import FrameData
-from .pdb_consts import ATOM_IDS, RES_LINKAGES, RES3_INFO
+from .pdb_consts import ATOM_IDS, ATOM_ID_LUT, RES_LINKAGES_NP, RES_LINKAGES_LEN, RES3_INFO, RES3_INFO_NATOMS
 
 import numpy as np
-from os.path import isfile
+from os.path import isfile, getsize
+from functools import lru_cache
+from mmap import mmap, ACCESS_READ
 
-from typing import List, Dict
+from typing import List, Dict, Tuple, Union
+
+_COORD_RECORDS = ("ATOM  ", "HETATM")
+_COORD_RECORDS_BYTES = np.frombuffer(b"ATOM  HETATM", dtype=np.uint8).reshape(2, 6)
+# Fields of the array returned by get_residues_from_pdb_list
+RESIDUE_INFO_DTYPE = np.dtype([("atom_id", "S5"), ("res_id", "S4"), ("res_name", "S3")])
 
 
 def get_residues_from_pdb_list(pdb : list) -> np.array:
-  """"""
+  """
+  Gets the atom id, residue id and residue name of each coordinate entry in a pdb list.
+
+  :param pdb: List where each entry corresponds to a line in the pdb file.
+  :return atom_res_index: Structured array of dtype RESIDUE_INFO_DTYPE, with fields atom_id, res_id and res_name.
+  """
   if not pdb:
     return None
-  atom_res_index = np.empty((len(pdb), 3), dtype=object) # [ atom_id, res_id, res_name ]
-  count = 0
-
-  for line in pdb:
-    if line[0:6] == "ATOM  " or line[0:6] == "HETATM": # If atom entry:
-      atom_res_index[count] = np.array([line[6:11], line[22:26], line[17:20]], dtype=str)
-      count += 1
-
-  atom_res_index = atom_res_index[:count, :]
+  records = _get_atom_records(pdb)
+  atom_res_index = np.empty(len(records), dtype=RESIDUE_INFO_DTYPE)
+  atom_res_index["atom_id"] = _get_record_columns(records, 6, 11).ravel()
+  atom_res_index["res_id"] = _get_record_columns(records, 22, 26).ravel()
+  atom_res_index["res_name"] = _get_record_columns(records, 17, 20).ravel()
   return atom_res_index
 
 
@@ -32,6 +40,201 @@ def get_residues_from_pdb_string(pdb : str,
   return get_residues_from_pdb_list(pdb.split(delimiter))
 
 
+def _get_atom_records(pdb : list) -> np.ndarray:
+  """
+  Packs the coordinate entries of a pdb list into a single fixed width byte array.
+  Each line is padded (or truncated) to the 80 columns of the official pdb format, so that
+  every field can then be sliced out of all records at once.
+
+  :param pdb: List where each entry corresponds to a line in the pdb file.
+  :return records: Array of shape (N, 80) and dtype uint8 containing only the ATOM and HETATM entries.
+  """
+  buf = "".join(line.rstrip("\r\n").ljust(80)[:80] for line in pdb if line.startswith(_COORD_RECORDS))
+  return np.frombuffer(buf.encode("ascii"), dtype=np.uint8).reshape(-1, 80)
+
+
+def _get_atom_records_from_buffer(buf) -> np.ndarray:
+  """
+  As _get_atom_records, but packs the coordinate entries straight from the bytes of a pdb,
+  e.g. a memory mapped file, without splitting it into per line strings.
+
+  :param buf: Any object supporting the buffer protocol containing the contents of a pdb file.
+  :return records: Array of shape (N, 80) and dtype uint8 containing only the ATOM and HETATM entries.
+  """
+  data = np.frombuffer(buf, dtype=np.uint8)
+  newlines = np.flatnonzero(data == ord("\n"))
+  line_starts = np.concatenate(([0], newlines + 1))
+  line_ends = np.append(newlines, len(data))
+  # Only lines long enough to hold a record name can be coordinate entries
+  is_long = line_ends - line_starts >= 6
+  line_starts, line_ends = line_starts[is_long], line_ends[is_long]
+  heads = data[line_starts[:, np.newaxis] + np.arange(6)]
+  is_coord = (heads[:, np.newaxis, :] == _COORD_RECORDS_BYTES).all(axis=2).any(axis=1)
+  line_starts, line_ends = line_starts[is_coord], line_ends[is_coord]
+  line_ends -= data[line_ends - 1] == ord("\r")
+  # Gather the first 80 columns of every coordinate line, padding short lines with spaces
+  columns = line_starts[:, np.newaxis] + np.arange(80)
+  records = data[np.minimum(columns, len(data) - 1)]
+  records[columns >= line_ends[:, np.newaxis]] = ord(" ")
+  return records
+
+
+def _get_record_columns(records : np.ndarray,
+                        start : int,
+                        stop : int,
+                        field_width : int = None) -> np.ndarray:
+  """
+  Gets the given columns of each record as a fixed width bytes array, e.g. [30, 38) for the x coordinate.
+  If field_width is given the columns are split into consecutive fields of that width, e.g. [30, 54) for all coordinates.
+  """
+  return np.ascontiguousarray(records[:, start:stop]).view(f"S{field_width or stop - start}")
+
+
+def _get_atom_elements(records : np.ndarray) -> np.ndarray:
+  """
+  Maps the element symbol of each record to its atomic number, packing both characters of the symbol
+  into a key of ATOM_ID_LUT.
+
+  :raises KeyError: If an element symbol is not contained in ATOM_IDS, or contains characters other than letters and spaces.
+  """
+  columns = records[:, 76:78]
+  # Masking the key aliases other characters onto letters (e.g. " 3" onto " S"), so only letters and spaces are accepted
+  lower = columns | 0x20
+  is_valid = ((columns == 0x20) | ((lower >= 0x61) & (lower <= 0x7a))).all(axis=1)
+  symbols = columns.astype(np.int16) & 0x1f
+  atom_ids = ATOM_ID_LUT[(symbols[:, 0] << 5) | symbols[:, 1]]
+  atom_ids[~is_valid] = 0
+  if not atom_ids.all():
+    unknown = records[np.argmin(atom_ids), 76:78]
+    raise KeyError(unknown.tobytes().decode(errors="replace").strip())
+  return atom_ids
+
+
+def _get_atom_coords(records : np.ndarray) -> np.ndarray:
+  """
+  Parses the x, y and z fields of each record by packing the 8 characters of each field into a 64 bit integer
+  and combining its digits in place (SWAR), so every field is handled by a few whole array integer operations.
+  Falls back to a string to float conversion if any field does not follow the %8.3f format.
+
+  :return atom_coords: Array of shape (N, 3) containing the atom coordinates in Angstroms.
+  """
+  fields = np.ascontiguousarray(records[:, 30:54]).reshape(-1, 8)
+  digits = fields - np.uint8(ord("0")) # Non digit characters wrap around to values above 9
+  is_digit = digits < 10
+  is_valid = is_digit | (fields == np.uint8(ord(" "))) | (fields == np.uint8(ord("-")))
+  is_valid[:, 4] = fields[:, 4] == np.uint8(ord("."))
+  if not is_valid.all():
+    return _get_record_columns(records, 30, 54, 8).astype(np.float32)
+  digits *= is_digit
+  # Each field is read as a single little endian integer, holding its first character in the lowest byte
+  # digits is a fresh array, so every step below works in place with a single scratch array rather than allocating temporaries
+  packed = digits.view("<u8").ravel()
+  # The integer digits are moved over the decimal point, so that "dddd.ddd" becomes the 7 digit integer ddddddd
+  scratch = packed & np.uint64(0xFFFFFF0000000000)
+  packed <<= np.uint64(8)
+  packed &= np.uint64(0x000000FFFFFFFF00)
+  packed |= scratch
+  # Neighbouring digits are combined, then pairs of digits and then fours
+  for scale, shift, mask in ((10, 8, 0x00FF00FF00FF00FF), (100, 16, 0x0000FFFF0000FFFF), (10000, 32, 0x00000000FFFFFFFF)):
+    np.right_shift(packed, np.uint64(shift), out=scratch)
+    packed *= np.uint64(scale)
+    packed += scratch
+    packed &= np.uint64(mask)
+  atom_coords = packed.astype(np.float32)
+  # Likewise a field contains a "-" if any of its 8 byte flags are set
+  is_negative = (fields == np.uint8(ord("-"))).view("<u8").ravel() != 0
+  np.negative(atom_coords, out=atom_coords, where=is_negative)
+  atom_coords /= 1000
+  return atom_coords.reshape(-1, 3)
+
+
+@lru_cache(maxsize=64)
+def _get_residue_links(res_list : Tuple[str, ...]) -> np.ndarray:
+  """
+  Builds the bond pairs of a sequence of residues from the residue templates in pdb_consts.py.
+  The bonds only depend on the residue sequence, so they are cached on it and shared between frames of the same pose.
+
+  :param res_list: Tuple of the 3 letter residue names, in order.
+  :return atom_links: Read only array of shape (N, 2) containing the bond pairs.
+  """
+  inner_res = res_list[1:-1] # TODO figure out how to deal with termini cases, for now ignore them
+  res_offsets = np.cumsum([0] + [ RES3_INFO_NATOMS[res] for res in inner_res ])[:-1]
+  # Links between adjacent residues, C-terminal linkage atom of one to the N-terminal linkage atom of the next
+  c_term = np.array([ RES3_INFO[res][2] for res in inner_res[:-1] ], dtype=np.int32) + res_offsets[:-1]
+  n_term = np.array([ RES3_INFO[res][1] for res in inner_res[1:] ], dtype=np.int32) + res_offsets[1:]
+  # Bond count is known from the residue templates, so the bond array is allocated once at its exact size
+  res_link_counts = [ RES_LINKAGES_LEN[res] for res in inner_res ]
+  n_res_links = sum(res_link_counts)
+  atom_links = np.empty((n_res_links + len(c_term), 2), dtype=np.int32)
+  if inner_res:
+    # Templates are copied in unchanged and then offset by their residue's first atom in a single add
+    np.concatenate([ RES_LINKAGES_NP[res] for res in inner_res ], out=atom_links[:n_res_links])
+    atom_links[:n_res_links] += np.repeat(res_offsets, res_link_counts)[:, np.newaxis]
+  atom_links[n_res_links:, 0] = c_term
+  atom_links[n_res_links:, 1] = n_term
+  atom_links += ( 2 + RES3_INFO[res_list[0]][0] ) # Need to account for additional 2 H atoms at N terminus
+  atom_links.flags.writeable = False
+  return atom_links
+
+
+def _parse_atom_records(records : np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+  """
+  Parses the coordinate entries of a pdb into the arrays needed to build a FrameData object.
+
+  :param records: Array of shape (N, 80) as returned by _get_atom_records.
+  :return (positions, bond_pairs, elements, residues, residue_count): Flattened positions in nm, flattened bond pairs,
+    atomic numbers and residue ids of each atom, and the number of residues.
+  """
+  # Coordinate entries are parsed column-wise in a single pass rather than line by line
+  atom_coords = _get_atom_coords(records)
+  atom_ids = _get_atom_elements(records)
+  atom_res = _get_record_columns(records, 22, 26).ravel().astype(int)
+
+  # TODO consider multichain proteins, as this current implementation doesnt work properly
+  # The first entry of each residue is used to get its name, these are used to build atom linkages.
+  _, res_first_atom = np.unique(atom_res, return_index=True)
+  res_names = _get_record_columns(records, 17, 20).ravel()[res_first_atom]
+
+  res_list = tuple( res.decode() for res in res_names )
+  atom_links = _get_residue_links(res_list)
+
+  # atom_coords is a fresh contiguous array, so it is scaled in place and reshaped as a view rather than copied
+  atom_coords /= 10 # As PDB is in Angstroms but Narupa uses nm
+  return atom_coords.reshape(-1), atom_links.reshape(-1), atom_ids, atom_res, len(res_list)
+
+
+def _build_framedata(positions : np.ndarray,
+                     bond_pairs : np.ndarray,
+                     elements : np.ndarray,
+                     residues : np.ndarray,
+                     residue_count : int) -> FrameData:
+  """
+  Builds a new FrameData object from the arrays returned by _parse_atom_records.
+  """
+  frame = FrameData()
+  frame.arrays["particle.positions"] = positions
+  frame.arrays["bond.pairs"] = bond_pairs
+  frame.arrays["particle.elements"] = elements
+  frame.arrays["particle.residues"] = residues
+  frame.residue_count = residue_count
+  frame.particle_count = len(elements)
+  frame.chain_count = 1 # TODO consider multiple chains
+  return frame
+
+
+@lru_cache(maxsize=32)
+def _parse_pdb_string(pdb_string : str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+  """
+  Memoised _parse_atom_records for whole pdb strings. Poses are often converted more than once,
+  e.g. when a stored frame is resent, so the parsed arrays of recent pdbs are kept.
+  The arrays are set to read only as they are shared between callers.
+  """
+  parsed = _parse_atom_records(_get_atom_records(pdb_string.split("\n")))
+  for array in parsed[:-1]:
+    array.flags.writeable = False
+  return parsed
+
+
 def convert_pdb_list_to_framedata(pdb : list) -> FrameData:
   """
   Method to quickly build a FrameData object from a pdb list.
@@ -45,91 +248,62 @@ def convert_pdb_list_to_framedata(pdb : list) -> FrameData:
   :param pdb: String corresponding to the contents of a pdb file.
   :return frame: FrameData object corresponding to the given PDB
   """
-  num_lines = len(pdb)
-  atom_coords = np.zeros((num_lines, 3), dtype=float)
-  atom_links = np.zeros((num_lines ** 2, 2), dtype=int)
-  atom_ids = np.zeros((num_lines,), dtype=int)
-  res_list = [""] * num_lines
-  atom_res = np.zeros((num_lines,), dtype=int)
-  count = 0
-  for ii, line in enumerate(pdb):
-    if line[0:6] == "ATOM  " or line[0:6] == "HETATM":
-      # Only care about atom coordinate entries
-      atom_coords[count] = np.array([line[30:38], line[38:46], line[46:54]])
-      atom_ids[count] = ATOM_IDS[line[76:78].strip()]
-      atom_res[count] = int(line[22:26])
-
-      if res_list[atom_res[count] - 1] == "": # TODO consider multichain proteins, as this current implementation doesnt work properly
-        # If we haven't recorded the entry before then get the next res
-        # Will eventually use these entries to build atom linkages.
-        res_list[atom_res[count] - 1] = line[17:20]
-      count += 1
-  atom_coords = atom_coords[:count]
-  atom_ids = atom_ids[:count]
-  atom_res = atom_res[:count]
-
-  res_list = [ res for res in res_list if res != "" ]
-  count, atom_count = 0, 0
-  for ii, res in enumerate(res_list):
-    if ii == 0:
-      continue
-    if ii == len(res_list) - 1:
-      continue # TODO figure out how to deal with termini cases, for now ignore them
-    atom_links[count : count + len(RES_LINKAGES[res])] = np.asarray(RES_LINKAGES[res], dtype=int) + atom_count
-    count += len(RES_LINKAGES[res])
-    atom_count += RES3_INFO[res][0]
-  atom_count = 0
-  for ii in range( 2, len(res_list) - 1 ): # Now add all links between residues
-    # TODO consider termini
-    atom_links[count] = np.asarray([RES3_INFO[res_list[ii - 1]][2] + atom_count,
-                                    RES3_INFO[res_list[ii]][1] + atom_count + RES3_INFO[res_list[ii - 1]][0]], dtype=int)
-    atom_count += RES3_INFO[res_list[ii - 1]][0]
-    count += 1
-  atom_links += ( 2 + RES3_INFO[res_list[0]][0] ) # Need to account for additional 2 H atoms at N terminus
-
-  atom_links = atom_links[:count]
-  frame = FrameData()
-  frame.arrays["particle.positions"] = atom_coords.flatten() / 10 # As PDB is in Angstroms but Narupa uses nm
-  frame.arrays["bond.pairs"] = atom_links.flatten()
-  frame.arrays["particle.elements"] = atom_ids
-  frame.arrays["particle.residues"] = atom_res
-  frame.residue_count = len(res_list)
-  frame.particle_count = len(atom_ids)
-  frame.chain_count = 1 # TODO consider multiple chains
-  return frame
+  return _build_framedata(*_parse_atom_records(_get_atom_records(pdb)))
 
 
 def convert_pdb_file_to_framedata(pdb_file : str):
   """
   Converts a pdb file into a FrameData object.
-  Parses the file and then passes the resulting list to the
-  convert_pdb_list_to_framedata method.
+  The file is memory mapped and its coordinate entries parsed directly from the mapped bytes,
+  so large files are never read into a list of lines.
 
   :param pdb_file: A string corresponding the location of the pdb file to be converted.
   :raises FileNotFoundError: If the designated file cannot be located.
-  :return frame: Return value from convert_pdb_list_to_framedata method.
+  :return frame: FrameData object corresponding to the given PDB.
   """
-  if isfile( pdb_file ):
-    with open(pdb_file, "r") as r:
-      pdb_lines = r.readlines()
-  else:
+  if not isfile( pdb_file ):
     raise FileNotFoundError(f"The given file ({pdb_file}) was not found..")
-  return convert_pdb_list_to_framedata(pdb_lines)
+  if getsize( pdb_file ) == 0: # An empty file cannot be mapped
+    return convert_pdb_list_to_framedata([])
+  with open(pdb_file, "rb") as r, mmap(r.fileno(), 0, access=ACCESS_READ) as pdb_buffer:
+    records = _get_atom_records_from_buffer(pdb_buffer)
+  return _build_framedata(*_parse_atom_records(records))
+
+
+def convert_pdb_string_to_framedata(pdb_string : Union[str, bytes]):
+  """
+  Splits a pdb string on new lines and converts it as in the convert_pdb_list_to_framedata method.
+  The parsed arrays of the most recent pdb strings are cached, so converting the same pdb again only
+  builds a new FrameData object.
+
+  :param pdb_string: PDB string to be split, may also be given as the raw ascii bytes of the pdb.
+  :return frame: FrameData object corresponding to the given PDB.
+  """
+  if isinstance(pdb_string, (bytes, bytearray, memoryview)):
+    # Decoding is cheap next to parsing, and keeps a single cache and parser for both
+    pdb_string = bytes(pdb_string).decode("ascii")
+  return _build_framedata(*_parse_pdb_string(pdb_string))
 
 
-def convert_pdb_string_to_framedata(pdb_string : str):
+def convert_pdb_string_to_frame_update(pdb_string : str,
+                                       topology : Tuple[np.ndarray, ...] = None) -> Tuple[FrameData, Tuple[np.ndarray, ...]]:
   """
-  Splits a pdb string using the given delimiter character.
-  The delimiter should be used only at the end of each new line.
-  No additional process is made to the string and the resulting list is
-  passed to the convert_pdb_list_to_framedata method.
+  Converts a pdb string into a FrameData object to be sent after a previous frame of the same pose.
+  If the pdb has the same topology (bonds, elements and residues) as the previous frame only the particle positions
+  are set, as everything else is unchanged. Otherwise the full frame is built as in convert_pdb_string_to_framedata.
 
-  :param pdb_string: PDB string to be split.
-  :param delim: Delimiter to use to split the pdb string with. The delimiter should only be used to split new lines
-  :return frame: FrameData object returned by the convert_pdb_list_to_framedata method.
+  :param pdb_string: PDB string to be converted.
+  :param topology: Topology returned with the previous frame, if None the full frame is always built.
+  :return (frame, topology): FrameData object corresponding to the given PDB and its topology, to be passed with the next frame.
+    The given topology object is returned unchanged if and only if the frame only contains the particle positions.
   """
-  pdb_list = pdb_string.split("\n")
-  return convert_pdb_list_to_framedata(pdb_list)
+  positions, bond_pairs, elements, residues, residue_count = _parse_pdb_string(pdb_string)
+  if topology is not None and all(new is old or np.array_equal(new, old)
+                                  for new, old in zip((bond_pairs, elements, residues), topology)):
+    frame = FrameData()
+    frame.arrays["particle.positions"] = positions
+    return frame, topology
+  return _build_framedata(positions, bond_pairs, elements, residues, residue_count), (bond_pairs, elements, residues)
 
 
 def _get_bond_pairs_from_pose_info(bond_pairs : List[List]) -> np.array:
@@ -137,10 +311,35 @@ def _get_bond_pairs_from_pose_info(bond_pairs : List[List]) -> np.array:
   Returns an array of bond pairs in the shape (N, 2) correpsonding to atom links
   in the format expected by Narupa.
   Atom bond pairs from Rosetta PoseInfo are formatted in an ordered list where the index
-  corresponds to the atom number and the following
+  corresponds to the atom number and the following entry is the list of atoms bonded to it.
   The PoseInfo is 1-indexed as standard for Rosetta numbering.
   """
-  pass
+  counts = [ len(bonded) for bonded in bond_pairs ]
+  atom_links = np.empty((sum(counts), 2), dtype=np.int32)
+  atom_links[:, 0] = np.repeat(np.arange(len(bond_pairs), dtype=np.int32), counts)
+  atom_links[:, 1] = [ atom - 1 for bonded in bond_pairs for atom in bonded ]
+  # Each bond is listed from both of its atoms, only keep one copy
+  return atom_links[atom_links[:, 0] < atom_links[:, 1]]
+
+
+def normalise_pose_info(pose_info : Dict[str, List]) -> Dict[str, np.ndarray]:
+  """
+  Converts PoseInfo as returned by the json RequestPoseInfo command into the arrays returned by RequestPoseInfoBinary:
+    atom_coords - float32 coords in Angstroms (shape = (N, 3)),
+    atom_elements - uint8 atomic numbers (shape = (N,)),
+    atom_bonds - int32 zero indexed bond pairs, each bond listed once (shape = (M, 2)),
+    atom_residues - int32 residue each atom belongs to (shape = (N,))
+  PoseInfo already in this form is returned as it is.
+
+  :param pose_info: Dict as returned by either the RequestPoseInfo or RequestPoseInfoBinary command.
+  :return pose_info: Dict of the above arrays.
+  """
+  if isinstance(pose_info["atom_elements"], np.ndarray):
+    return pose_info
+  return { "atom_coords" : np.array(pose_info["atom_coords"], dtype=np.float32).reshape(-1, 3),
+           "atom_elements" : np.array([ ATOM_IDS[element.upper()] for element in pose_info["atom_elements"] ], dtype=np.uint8),
+           "atom_bonds" : _get_bond_pairs_from_pose_info(pose_info["atom_bonds"]),
+           "atom_residues" : np.array(pose_info["atom_residues"], dtype=np.int32) }
 
 
 def convert_pose_info_to_framedata(pose_info : Dict[str, List]) -> FrameData:
@@ -150,9 +349,14 @@ def convert_pose_info_to_framedata(pose_info : Dict[str, List]) -> FrameData:
     atom_coords - ordered list of atom coords (shape = (N, 3)),
     atom_bonds - 1 indexed ordered list of list of bonds of atoms,
     atom_residues - ordered list of corresponding the residue an atom belongs to
+  PoseInfo already converted to arrays, see normalise_pose_info, is also accepted.
+  The FrameData object is built in the same way as for the pdb converters.
+
+  :param pose_info: Dict as returned by the RequestPoseInfo command or RosettaRunner.request_pose_info.
+  :return frame: FrameData object corresponding to the given PoseInfo.
   """
-  frame = FrameData()
-  frame.arrays["particle.positions"] =  np.array(pose_info["atom_coords"], type=float)
-  frame.arrays["particle.elements"] =   np.array(pose_info["atom_elements"], dtype="U2")
-  frame.arrays["particle.residues"] =   np.array(pose_info["atom_residues"], dtype=int)
-  frame.arrays["bond.pairs"] = _get_bond_pairs_from_pose_info(pose_info["atom_bonds"])
\ No newline at end of file
+  pose_info = normalise_pose_info(pose_info)
+  positions = pose_info["atom_coords"].reshape(-1) / np.float32(10) # As Rosetta is in Angstroms but Narupa uses nm
+  residues = pose_info["atom_residues"]
+  return _build_framedata(positions, pose_info["atom_bonds"].reshape(-1), pose_info["atom_elements"], residues,
+                          len(np.unique(residues)))
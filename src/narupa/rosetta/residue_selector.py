@@ -4,13 +4,16 @@
 import xml.etree.ElementTree as xml
 import numpy as np
 
-ACCEPTED_RES_SELECTORS = [ "Index" ]
+ACCEPTED_RES_SELECTORS = frozenset(( "Index", ))
 
 class ResidueSelector:
   """
   Container class for convience when building new residue selectors for RosettaScrips.
   Is used in the RosettaScripts builder when constructing new XMls
   """
+  # Selectors are created for every combination and inversion, slots keep them small
+  __slots__ = ( "name", "type", "_residues", "_resnums", "_xml" )
+
   def __init__( self,
                 name : str = None,
                 sele_type : str = None,
@@ -25,27 +28,40 @@ class ResidueSelector:
     elif not sele_type:
       self.type = "Index"
     else:
-      raise ValueError( f"Residue selector type of {sele_type} is not accepted. See Rosetta documentation or ACCEPTED_RES_SELECTORS for the list of accepted types.")
+      raise ValueError( f"Residue selector type of {sele_type} is not accepted. See Rosetta documentation or ACCEPTED_RES_SELECTORS for the set of accepted types.")
 
+    # Residues are kept as a sorted, unique int32 array which is updated in place of being re-sorted
     if res_list is not None:
-      self.residues = np.unique( res_list ).astype(int)
+      self.residues = np.unique( np.asarray( res_list ).astype(np.int32) )
     else:
-      self.residues = np.array( [], dtype=int )
+      self.residues = np.array( [], dtype=np.int32 )
+
+
+  @property
+  def residues( self ) -> np.ndarray:
+    return self._residues
 
+  @residues.setter
+  def residues( self, residues : np.ndarray ):
+    self._residues = residues
+    self._resnums = None # Serialised lazily by to_string
+    self._xml = None # Built lazily by to_xml
 
   @property
   def is_empty( self ) -> bool:
-    return not len(self.residues) > 0
+    return self.residues.size == 0
 
   def _validate( self ) -> bool:
     if self.type in ACCEPTED_RES_SELECTORS:
       return True
     else:
-      raise ValueError( f"Residue selector type of {self.type} is not accepted. See Rosetta documentation or ACCEPTED_RES_SELECTORS for the list of accepted types.")
+      raise ValueError( f"Residue selector type of {self.type} is not accepted. See Rosetta documentation or ACCEPTED_RES_SELECTORS for the set of accepted types.")
 
   def to_string( self ) -> str:
     self._validate()
-    return ",".join( self.residues.astype(str) )
+    if self._resnums is None:
+      self._resnums = ",".join( map( str, self.residues.tolist() ) )
+    return self._resnums
 
   def to_dict( self ) -> dict:
     self._validate()
@@ -53,23 +69,36 @@ class ResidueSelector:
 
   def to_xml( self ) -> xml.Element:
     self._validate()
-    return xml.Element( self.type,
-                        name=self.name,
-                        resnums=self.to_string(),
-                        error_on_out_of_bounds_index="true",
-                        reverse="false")
+    # The element is reused until the residues change, name and type are public so are checked each call
+    if self._xml is None or self._xml.tag != self.type or self._xml.get( "name" ) != self.name:
+      self._xml = xml.Element( self.type,
+                               name=self.name,
+                               resnums=self.to_string(),
+                               error_on_out_of_bounds_index="true",
+                               reverse="false")
+    return self._xml
 
   def add_residues( self,
-                    pdb_info : np.ndarray, # Expected to be [ atom_id, res_id, res_name ]
+                    pdb_info : np.ndarray, # Expected to have the fields atom_id, res_id and res_name
                     atom_selections : np.ndarray ):
     """
     Converts list of atom selectons to a unique set of residue ids.
 
-    :param pdb_info: Numpy array of shape (N, 3) in the form [ atom_id, res_id, res_name ]
-    :param atom_selections: list of atom ids for the selection.
+    :param pdb_info: Structured numpy array with the fields atom_id, res_id and res_name, see get_residues_from_pdb_list
+    :param atom_selections: list of zero indexed atom ids for the selection.
+    """
+    self.add_residue_ids( self._get_selected_residues( pdb_info, atom_selections ) )
+
+  def add_residue_ids( self,
+                       new_res : np.ndarray ):
     """
-    idx = np.isin( pdb_info[:, 0].astype(int), atom_selections.astype(int) )
-    self.residues = np.unique( np.concatenate( (self.residues, pdb_info[idx, 1].astype(int) )) )
+    Adds residues given directly by their ids, e.g. when the same residues are added to several selectors.
+
+    :param new_res: Sorted, unique int array of residue ids.
+    """
+    pos = np.searchsorted( self.residues, new_res )
+    is_new = ~self._is_present( pos, new_res )
+    self.residues = np.insert( self.residues, pos[is_new], new_res[is_new] )
 
   def remove_residues( self,
                        pdb_info : np.ndarray,
@@ -77,11 +106,42 @@ class ResidueSelector:
     """
     Converts a list of atom selections to a unique set of residue ids and removes those from the current list of residues
 
-    :param pdb_info:
-    :param atom_selections:
+    :param pdb_info: Structured numpy array with the fields atom_id, res_id and res_name, see get_residues_from_pdb_list
+    :param atom_selections: list of zero indexed atom ids for the selection.
     """
-    idx = np.isin( pdb_info[:, 0].astype(int), atom_selections.astype(int) )
-    self.residues = self.residues[np.isin( self.residues, pdb_info[idx, 1].astype(int), invert=True )]
+    self.remove_residue_ids( self._get_selected_residues( pdb_info, atom_selections ) )
+
+  def remove_residue_ids( self,
+                          old_res : np.ndarray ):
+    """
+    Removes residues given directly by their ids, see add_residue_ids.
+
+    :param old_res: Sorted, unique int array of residue ids.
+    """
+    pos = np.searchsorted( self.residues, old_res )
+    keep = np.ones( len(self.residues), dtype=bool )
+    keep[pos[self._is_present( pos, old_res )]] = False
+    self.residues = self.residues[keep]
+
+  @staticmethod
+  def _get_selected_residues( pdb_info : np.ndarray,
+                              atom_selections : np.ndarray ) -> np.ndarray:
+    """
+    Gets the sorted, unique residue ids (as int32) of the atoms in atom_selections.
+    Atom selections are zero indexed particle ids, as used by Narupa and RosettaScriptsBuilder, where the pdb atom ids are 1 indexed.
+    """
+    idx = np.isin( pdb_info["atom_id"].astype(int) - 1, np.asarray( atom_selections ).astype(int) )
+    return np.unique( pdb_info["res_id"][idx].astype(np.int32) )
+
+  def _is_present( self,
+                   pos : np.ndarray,
+                   res : np.ndarray ) -> np.ndarray:
+    """
+    Given the np.searchsorted positions of res in the current residues, returns which of res are already present.
+    """
+    found = pos < len(self.residues)
+    found[found] = self.residues[pos[found]] == res[found]
+    return found
 
   def invert( self,
               pdb_info : np.ndarray ):
@@ -89,8 +149,21 @@ class ResidueSelector:
     Produces a copy of a given residue selector where the given residues are those in the given pdb_info
     but not in the current ResidueSelector object
 
-    :param pdb_info: Numpy array of shape (N, 3) in the form [ atom_id, res_id, res_name ]
+    :param pdb_info: Structured numpy array with the fields atom_id, res_id and res_name, see get_residues_from_pdb_list
     :return:
     """
     return ResidueSelector( name=self.name, sele_type=self.type,
-                            res_list=pdb_info[np.isin( pdb_info[:, 1].astype(int), self.residues, invert=True ), 1].astype(int) )
+                            res_list=pdb_info["res_id"][np.isin( pdb_info["res_id"].astype(int), self.residues, invert=True )].astype(int) )
+
+  def invert_within( self,
+                     residue_ids : np.ndarray ):
+    """
+    As invert, but given the residue ids of the pdb directly rather than its pdb_info, e.g. as cached when the pdb is loaded.
+    As both arrays are sorted and unique the inverted residues are found without converting or re-sorting either.
+
+    :param residue_ids: Sorted, unique int array of all residue ids in the pdb.
+    :return: New ResidueSelector with the same name and type, containing the residues not in the current selector.
+    """
+    inverted = ResidueSelector( name=self.name, sele_type=self.type )
+    inverted.residues = np.setdiff1d( residue_ids, self.residues, assume_unique=True ).astype( np.int32, copy=False )
+    return inverted
@@ -42,8 +42,12 @@ class RosettaCommandService(CommandService):
                                   {} )
     self.register_rosetta_command("ros/send_pose", SendPose,
                                   { "pose_to_store" : None })
+    self.register_rosetta_command("ros/store_and_send_pose", StoreAndSendPose,
+                                  { "pose_to_store" : None })
     self.register_rosetta_command("ros/request_pose", RequestPose,
                                   { "pose_name" : None })
+    self.register_rosetta_command("ros/request_pose_batch", RequestPoseBatch,
+                                  { "pose_names" : None })
     self.register_rosetta_command("ros/request_pose_info", RequestPoseInfo,
                                   { "pose_name" : None })
     self.register_rosetta_command("ros/request_pose_list", RequestPoseList,
@@ -56,12 +60,13 @@ class RosettaCommandService(CommandService):
                                rosetta_command_obj : RosettaCommand,
                                execute_args : dict = None) -> None:
     #todo help text
-    if "client" in execute_args.keys():
+    if execute_args and "client" in execute_args:
       raise KeyError( "\"client\" is a protected argument and therefore cannot be used." )
     # As it is a Rosetta command and we need access to the RosettaClient we will use a prefix to discriminate
-    if rosetta_command_name.split("/")[0] != "ros":
+    if not rosetta_command_name.startswith("ros/"):
       rosetta_command_name = "ros/" + rosetta_command_name
-    self.register_command( rosetta_command_name, rosetta_command_obj.execute, execute_args )
+    # The command is bound to the client once here, as in RosettaRunner, so each call goes straight to _execute
+    self.register_command( rosetta_command_name, rosetta_command_obj(self.client)._execute, execute_args )
 
   def RunCommand(self, request, context) -> CommandReply:
     #TODO help text
@@ -72,15 +77,8 @@ class RosettaCommandService(CommandService):
       message = f'Unknown command: {command}'
       context.set_details(message)
       return
-    args = command.info.arguments
-    args.update(struct_to_dict(request.arguments))
-
-    # Add the client to the list of arguments if it is a rosetta specific command
-    if name.split("/")[0] == "ROS":
-      if args is None:
-        args = { "client" : self.client }
-      else:
-        args["client"] = self.client
+    # Merged into a new dict, updating command.info.arguments would change the defaults seen by later calls
+    args = { **(command.info.arguments or {}), **struct_to_dict(request.arguments) }
 
     results = command.callback(**args)
     if results is not None:
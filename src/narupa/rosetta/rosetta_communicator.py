@@ -2,9 +2,20 @@
 # Licensed under the GPL. See License.txt in the project root for license information.
 
 import zmq
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
 
 DEFAULT_ROSETTA_ADDRESS = "localhost"
 DEFAULT_ROSETTA_PORT = 43234
+DEFAULT_REPLY_TIMEOUT = 10000 # Wait a maximum of 10 seconds (in ms) for a reply from Rosetta
+CONNECTION_TEST_TIMEOUT = 1000 # ms, the echo of test_connection needs no work from Rosetta so should be answered quickly
+_POLL_INTERVAL = 50 # ms, the socket lock is released between polls so other threads can send requests
+# Pre-encoded frames of the connection test, sent as they are
+ECHO_KEY = b"ECHO"
+KEY_ERROR = b"KEY_ERROR" # Reply to any request whose key the server does not recognise
+TEST_MSG = b"test message"
 
 class ResponseTimeoutError(Exception):
   pass
@@ -28,11 +39,56 @@ class RosettaClient:
     self._ros_server_port = rosetta_server_port
     self._id = "RosettaClient|{}|{}".format(rosetta_server_address, rosetta_server_port)
     # ZeroMQ Context and Socket objects for communication with Rosetta
-    self._context = zmq.Context()
-    self._socket = self._context.socket(zmq.REQ)
-    self._socket.identity = b"NarupaClient"
-    self._socket.setsockopt(zmq.RCVTIMEO, 10000) # Wait a maximum of 10 seconds when receiving messages
+    # A DEALER socket is used so that requests can be sent before earlier replies have been received.
+    # Each request is preceded by an empty delimiter frame, the same framing as a REQ socket uses.
+    # The process wide zmq Context is shared between all clients (and their IO threads), so it is never terminated by a client
+    self._context = zmq.Context.instance()
+    self._socket_lock = Lock()
+    # Rosetta replies to requests in the order they are received, so replies are matched to the oldest pending request
+    # whose key they answer, see _recv_reply. If a reply times out the socket is replaced, see _reset_socket.
+    self._pending_replies = deque() # (reply keys accepted, Future) of each request awaiting its reply
+    self._uncollected_replies = deque() # Requests sent with send_messages, collected by recv_messages
     self._is_connected = False
+    self._socket_resets = 0
+    self._create_socket()
+    # Whether the Rosetta server is expected to support SEND_POSE_INFO_BIN, cleared if the server does not recognise it
+    self.binary_pose_info = True
+    # As above for STORE_POSE_ECHO, otherwise poses are stored with STORE_POSE and then requested
+    self.store_and_send_pose = True
+
+
+  def _create_socket(self) -> None:
+    """
+    Creates the DEALER socket (and its poller), connecting it if the client is already connected.
+    Each replacement socket has its own identity, so that late replies to the requests of a previous socket are
+    not routed to it.
+    """
+    self._socket = self._context.socket(zmq.DEALER)
+    if self._socket_resets:
+      self._socket.identity = f"NarupaClient|{self._socket_resets}".encode("utf-8")
+    else:
+      self._socket.identity = b"NarupaClient"
+    self._poller = zmq.Poller()
+    self._poller.register(self._socket, zmq.POLLIN)
+    if self._is_connected:
+      self._socket.connect(f"tcp://{self._ros_server_address}:{self._ros_server_port}")
+
+
+  def _reset_socket(self) -> None:
+    """
+    Fails every pending request with a ResponseTimeoutError then closes and recreates the socket ("lazy pirate").
+    Replies are only matched to requests by their order, so once a reply is missed any later reply would otherwise
+    be given to the wrong request. Must be called holding the socket lock.
+    """
+    while self._pending_replies:
+      reply = self._pending_replies.popleft()[1]
+      if not reply.done(): # Abandoned requests have already failed
+        reply.set_exception(
+          ResponseTimeoutError( "Rosetta Server did not respond to an earlier message request in time, the request was abandoned." ))
+    self._poller.unregister(self._socket)
+    self._socket.close(linger=0)
+    self._socket_resets += 1
+    self._create_socket()
 
 
   def connect(self) -> None:
@@ -41,48 +97,147 @@ class RosettaClient:
       _ros_server_address and _ros_server_address
     """
     print(f"Connecting to Rosetta server at: tcp://{self._ros_server_address}:{self._ros_server_port}")
-    self._socket.connect(f"tcp://{self._ros_server_address}:{self._ros_server_port}")
-    self._is_connected = True
+    with self._socket_lock:
+      self._socket.connect(f"tcp://{self._ros_server_address}:{self._ros_server_port}")
+      self._is_connected = True
 
 
   def test_connection(self) -> bool:
     """
     Sends a simple echo requests to the server and waits for a response
+    A timed out echo is abandoned rather than resetting the socket, so requests already in flight are unaffected.
 
     :return: :class: 'bool', Whether the server can be reached.
     """
     if self._is_connected:
-      self.send_messages(["ECHO", "test message"])
+      request = self.send_multipart_raw([ECHO_KEY, TEST_MSG])
       try:
-        self.recv_messages()
+        self.wait_for_reply(request, timeout=CONNECTION_TEST_TIMEOUT, reset_on_timeout=False)
         return True
-      except zmq.Again:
+      except ResponseTimeoutError:
         return False
     else: # Socket not connected to server
       self.connect()
       return self.test_connection()
 
 
+  @staticmethod
+  def _encode_messages(message_data : list) -> list:
+    """
+    Encodes each element of message_data as utf-8 to be sent as a frame of a multipart message.
+    Elements which are already bytes (or another bytes-like buffer) are sent as they are.
+
+    :raises TypeError: All elements of message_data object must be strings or convertible to strings
+    """
+    frames = []
+    for msg in message_data:
+      if isinstance(msg, str):
+        frames.append(msg.encode("utf-8"))
+      elif isinstance(msg, (bytes, bytearray, memoryview)):
+        frames.append(msg)
+      else:
+        try:
+          frames.append(str(msg).encode("utf-8"))
+        except Exception:
+          raise TypeError(f"{msg}\n Not convertible to string. All elements must either be or convertible to string.")
+    return frames
+
+
+  def send_request(self,
+                   message_data : list) -> Future:
+    """
+    Sends a list of message data to Rosetta without waiting for the reply, allowing several requests to be in flight.
+    Message data should be in the form: [MSG_KEY, MSG_DATA, ... MSG_DATA]
+
+    :param message_data: List of message data including the message key. Elements may also be pre-encoded bytes.
+    :raises TypeError: All elements of message_data object must be strings or convertible to strings
+    :return reply: Future resolved with the list of reply frames (as bytes) once received, see wait_for_reply.
+    """
+    return self.send_multipart_raw(self._encode_messages(message_data))
+
+
+  def send_multipart_raw(self,
+                         frames : list) -> Future:
+    """
+    As send_request, but the frames are sent as they are without being encoded.
+    Intended for callers which already hold the encoded message, e.g. constant keys or pre-built XML.
+
+    :param frames: List of bytes-like frames including the message key.
+    :return reply: Future resolved with the list of reply frames (as bytes) once received, see wait_for_reply.
+    """
+    reply = Future()
+    with self._socket_lock:
+      self._socket.send_multipart([b""] + frames, copy=False)
+      self._pending_replies.append(((b"REP_" + frames[0], b"ERR_" + frames[0], KEY_ERROR), reply))
+    return reply
+
+
+  def _recv_reply(self) -> None:
+    """
+    Receives a single reply and resolves the oldest pending request it answers. Must be called holding the socket lock.
+    As replies carry no request id, the reply key is checked against each request's key. Earlier requests skipped
+    over were dropped by the server, so fail. A reply answering no pending request, e.g. a late reply to one of those,
+    is dropped rather than shifting every later reply onto the wrong request. Abandoned requests (see wait_for_reply)
+    stay pending until their reply, which is then discarded, or a later reply skips over them.
+    """
+    frames = self._socket.recv_multipart()[1:] # Remove empty delimiter frame
+    reply_key = frames[0] if frames else None
+    for ii, (reply_keys, reply) in enumerate(self._pending_replies):
+      if reply_key in reply_keys:
+        for _ in range(ii):
+          skipped = self._pending_replies.popleft()[1]
+          if not skipped.done():
+            skipped.set_exception(
+              ResponseTimeoutError( "Rosetta Server replied to a later message request without replying to this one." ))
+        self._pending_replies.popleft()
+        if not reply.done():
+          reply.set_result(frames)
+        return
+
+
+  def wait_for_reply(self,
+                     reply : Future,
+                     timeout : int = DEFAULT_REPLY_TIMEOUT,
+                     reset_on_timeout : bool = True) -> list:
+    """
+    Receives replies from Rosetta until the given request has been replied to.
+    Replies to earlier requests are passed to their own futures as they are received.
+    If the reply times out while it is the oldest pending request the socket is reset, see _reset_socket, failing
+    every other pending request. Otherwise only this request is abandoned: it fails but stays pending, so that its
+    late reply is discarded by _recv_reply rather than given to a later request.
+
+    :param reply: Future returned by send_request.
+    :param timeout: Maximum time to wait for the reply in milliseconds, if None waits until the reply is received.
+    :param reset_on_timeout: Whether the socket may be reset on a timeout, if False the request is always abandoned.
+    :raises ResponseTimeoutError: If the reply is not received within the timeout.
+    :return frames: List of reply frames as bytes. The return key will always be the first entry in the list.
+    """
+    deadline = None if timeout is None else monotonic() + timeout / 1000
+    while not reply.done():
+      with self._socket_lock:
+        if not reply.done() and self._poller.poll(_POLL_INTERVAL):
+          self._recv_reply()
+        if deadline is not None and not reply.done() and monotonic() > deadline:
+          if reset_on_timeout and self._pending_replies and self._pending_replies[0][1] is reply:
+            self._reset_socket()
+          else:
+            reply.set_exception(ResponseTimeoutError( "Rosetta Server did not respond to message request in time." ))
+          raise ResponseTimeoutError( "Rosetta Server did not respond to message request in time." )
+    return reply.result()
+
+
   def send_messages(self,
                     message_data : list = []) -> None:
     """
     Sends a list of message data to Rosetta. Message data should be in the form:
     [MSG_KEY, MSG_DATA, ... MSG_DATA]
+    The reply should be collected with recv_messages.
 
     :param message_data: List of message data including the message key.
 
     :raises TypeError: All elements of message_data object must be strings or convertible to strings
     """
-    for ii, msg in enumerate(message_data, 1):
-      if type(msg) != str:
-        try:
-          msg = str(msg)
-        except:
-          raise TypeError(f"{msg}\n Not convertible to string. All elements must either be or convertible to string.")
-      if ii < len(message_data):
-        self._socket.send(msg.encode("utf-8"), flags=zmq.SNDMORE)
-      else: # if last message
-        self._socket.send(msg.encode("utf-8"))
+    self._uncollected_replies.append(self.send_request(message_data))
 
 
   def send_messages_sl(self,
@@ -112,17 +267,32 @@ class RosettaClient:
     self.send_messages(full_message)
 
 
-  def recv_messages(self) -> list:
+  def recv_messages(self,
+                    timeout_ms : int = DEFAULT_REPLY_TIMEOUT) -> list:
     """
-    Function to receive messages from Rosetta. The first entry in the list will always be the return key sent from Rosetta.
+    Function to receive messages from Rosetta, in reply to the earliest uncollected send_messages call.
+    The first entry in the list will always be the return key sent from Rosetta.
 
+    :param timeout_ms: Maximum time to wait for the reply in milliseconds, if None waits until the reply is received.
+    :raises ResponseTimeoutError: If the reply is not received within the timeout.
     :return all_msgs: List containing the message key and message data. The return key will always be the first entry in the list.
     """
-    all_msgs = [self._socket.recv().decode("utf-8")]
-    while self._socket.getsockopt(zmq.RCVMORE):
-      all_msgs.append(self._socket.recv().decode("utf-8"))
-    return all_msgs
+    return [frame.decode("utf-8") for frame in self.recv_messages_bytes(timeout_ms)]
+
+  def recv_messages_bytes(self,
+                          timeout_ms : int = DEFAULT_REPLY_TIMEOUT) -> list:
+    """
+    As recv_messages, but the frames are returned as bytes so that large replies (e.g. pdbs) are only decoded if needed.
+
+    :param timeout_ms: Maximum time to wait for the reply in milliseconds, if None waits until the reply is received.
+    :raises ResponseTimeoutError: If the reply is not received within the timeout.
+    :return all_msgs: List of bytes containing the message key and message data. The return key will always be the first entry in the list.
+    """
+    return self.wait_for_reply(self._uncollected_replies.popleft(), timeout=timeout_ms)
 
   def close(self) -> None:
-    self._socket.close()
-    self._context.term()
\ No newline at end of file
+    """
+    Closes the socket to Rosetta. The shared zmq Context is left open as other clients may still be using it.
+    """
+    with self._socket_lock:
+      self._socket.close()
\ No newline at end of file
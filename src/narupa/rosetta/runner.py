@@ -7,26 +7,32 @@ from narupa.app import NarupaImdClient
 from narupa.state.state_service import DictionaryChange
 
 # Rosetta required imports
-from .rosetta_communicator import RosettaClient, DEFAULT_ROSETTA_ADDRESS, DEFAULT_ROSETTA_PORT, FormatError
+from .rosetta_communicator import RosettaClient, DEFAULT_ROSETTA_ADDRESS, DEFAULT_ROSETTA_PORT, FormatError, ResponseTimeoutError
 from .command_util import (RosettaCommand, EchoMessage, CloseServer,
-                           SendPose, RequestPose, RequestPoseInfo, RequestPoseList,
+                           SendPose, StoreAndSendPose, RequestPose, RequestPoseBatch, RequestPoseInfo, RequestPoseInfoBinary, RequestPoseList,
                            SendAndParseXml)
 from .trajectory import RosettaTrajectoryManager
 from .xml_builder import RosettaScriptsBuilder
-from time import sleep
-from .pdb_util import convert_pdb_string_to_framedata
+from time import sleep, monotonic
+from .pdb_util import convert_pdb_string_to_framedata, normalise_pose_info
 
 # For iMD client controls
 from narupa.trajectory.frame_server import PLAY_COMMAND_KEY, RESET_COMMAND_KEY, STEP_COMMAND_KEY, PAUSE_COMMAND_KEY
 from typing import Dict
 
 # Other imports
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 from threading import RLock
+from types import MappingProxyType
+from sys import intern
 
 # Type hint imports
 from typing import List
 
+# Longest wait in seconds between pose requests while Rosetta has no pose to send, unless the request interval is longer
+_MAX_REQUEST_BACKOFF = 0.1
+_MIN_REQUEST_BACKOFF = 0.001
 
 
 class RosettaRunner:
@@ -41,25 +47,30 @@ class RosettaRunner:
                rosetta_server_port : int = DEFAULT_ROSETTA_PORT):
 
     self._app = NarupaImdApplication.basic_server(name=narupa_server_name, address=narupa_server_address, port=narupa_server_port)
-    self._frame_publisher = self._app.frame_publisher   # For convenience
     self._server = self._app.server                     # For convenience
     # self._renderer = NarupaImdClient.connect_to_single_server( address=self._server.address, port=self._server.port )
     self._renderer = NarupaImdClient.autoconnect()
     self._rosetta = RosettaClient(rosetta_server_address=rosetta_server_address, rosetta_server_port=rosetta_server_port)
     self._rosetta.connect()
-    self._trajectory = RosettaTrajectoryManager(frame_publisher=self._frame_publisher)
+    # Bound once as request_pose(_batch) is called for every frame during playback
+    self._pose_requester = RequestPose(self._rosetta)
+    self._request_pose = self._pose_requester._execute
+    self._request_pose_batch = RequestPoseBatch(self._rosetta)._execute
+    self._trajectory = RosettaTrajectoryManager(frame_publisher=self._app.frame_publisher)
     self._xml_builder = RosettaScriptsBuilder(renderer=self._renderer)
     self._server._state_service.state_dictionary.content_updated.add_callback(self._xml_builder.new_residues)
     # self._app.imd._interaction_updated_callback = self._xml_builder.new_residues
     # self._pdb_converter = TODO pdb->framedata converter manager needs to keep track of proteins to see what needs to be rebuilt each frame
 
-    self._ros_cmds = {}
-    self._register_commands()
-
-    # For concurrent playback and control
+    # For concurrent playback and control, the lock is also taken when registering commands
     self._lock = RLock()
     self._threads = ThreadPoolExecutor(max_workers=1)
     self._script_in_progress = False
+    self._shared_state = {} # Values last sent to the shared state dictionary, see _update_shared_state
+
+    # Replaced as a whole when a command is registered, so it can be read without taking the lock
+    self._ros_cmds = MappingProxyType({})
+    self._register_commands()
 
 
   def can_contact_rosetta(self) -> bool:
@@ -71,29 +82,18 @@ class RosettaRunner:
     return self._rosetta.test_connection()
 
   def _register_commands(self) -> None:
-    self._ros_cmds = { "ros/echo_message" : EchoMessage,
-                       "ros/close_server" : CloseServer,
-                       "ros/send_pose" : SendPose,
-                       "ros/request_pose" : RequestPose,
-                       "ros/request_pose_info" : RequestPoseInfo,
-                       "ros/request_pose_list" : RequestPoseList,
-                       "ros/send_and_parse_xml" : SendAndParseXml }
-
-    # Add commands specific to communicating with Rosetta
-    self._server.register_command("ros/echo_message", self.run_rosetta_command,
-                                      { "ros_cmd" : "ros/echo_message", "msg" : "TEST" })
-    self._server.register_command("ros/close_server", self.run_rosetta_command,
-                                      { "ros_cmd": "ros/close_server" })
-    self._server.register_command("ros/send_pose", self.run_rosetta_command,
-                                      { "ros_cmd" : "ros/send_pose", "pose_name" : None, "pose_to_store" : None })
-    self._server.register_command("ros/request_pose", self.request_pose, # For speed reasons getting a pdb will avoid dict look ups.
-                                      { "pose_name" : None })
-    self._server.register_command("ros/request_pose_info", self.run_rosetta_command,
-                                      { "pose_name" : None })
-    self._server.register_command("ros/request_pose_list", self.run_rosetta_command,
-                                      { "ros_cmd" : "ros/request_pose_list" })
-    self._server.register_command("ros/send_and_parse_xml", self.run_rosetta_command,
-                                      { "ros_cmd" : "ros/send_and_parse_xml", "pose_name" : None, "xml" : None } )
+    # Commands specific to communicating with Rosetta, registered with both the server and self._ros_cmds
+    self.register_rosetta_command("ros/echo_message", EchoMessage, { "msg" : "TEST" })
+    self.register_rosetta_command("ros/close_server", CloseServer, {})
+    self.register_rosetta_command("ros/send_pose", SendPose, { "pose_name" : None, "pose_to_store" : None })
+    self.register_rosetta_command("ros/store_and_send_pose", StoreAndSendPose, { "pose_name" : None, "pose_to_store" : None })
+    self.register_rosetta_command("ros/request_pose", RequestPose, { "pose_name" : None },
+                                  callback=self.request_pose) # For speed reasons getting a pdb will avoid dict look ups.
+    self.register_rosetta_command("ros/request_pose_batch", RequestPoseBatch, { "pose_names" : None },
+                                  callback=self.request_pose_batch)
+    self.register_rosetta_command("ros/request_pose_info", RequestPoseInfo, { "pose_name" : None })
+    self.register_rosetta_command("ros/request_pose_list", RequestPoseList, {})
+    self.register_rosetta_command("ros/send_and_parse_xml", SendAndParseXml, { "pose_name" : None, "xml" : None })
     self._server.register_command("get_rosetta_args", self.get_rosetta_command_args,
                                       { "ros_cmd_name" : "ros/echo_message" })
     # Compound commands to run a set of different rosetta commands together
@@ -128,12 +128,11 @@ class RosettaRunner:
     :param kwargs: Set of key work arguements and values accepted by the RosettaCommand being called.
     :return Dict: Returns dictionary result corresponding to the called RosettaCommand object. Call get_rosetta_command_args for more details.
     """
-    with self._lock:
-      if ros_cmd in self._ros_cmds.keys():
-        return self._ros_cmds[ros_cmd].execute(client=self._rosetta, **kwargs)
-      else:
-        raise KeyError("Rosetta command name not recognised. Stored commands include:\n"
-                       f"{self._ros_cmds}")
+    command = self._ros_cmds.get(ros_cmd)
+    if command is None:
+      raise KeyError("Rosetta command name not recognised. Stored commands include:\n"
+                     f"{list(self._ros_cmds)}")
+    return command._execute(**kwargs)
 
   def request_pose(self,
                    pose_name : str = None) -> Dict[str, str]:
@@ -144,31 +143,52 @@ class RosettaRunner:
     :raises FormatError: If the Rosetta server returns an error message. This most likely means the name is not recognised.
     :return Dict{ pose_pdb : pdb_string }: pdb_string corresponds to the PDB of the requested pose.
     """
-    return RequestPose.execute(client=self._rosetta, pose_name=pose_name)
+    return self._request_pose(pose_name)
+
+  def request_pose_batch(self,
+                         pose_names : List[str] = None) -> Dict[str, str]:
+    """
+    As request_pose, but requests several poses in a single round trip to the Rosetta server.
+
+    :param pose_names: Names of poses stored in the Rosetta server. Pose names cannot contain spaces.
+    :raises FormatError: If the Rosetta server returns an error message. This most likely means a name is not recognised.
+    :return Dict{ pose_name : pdb_string }: pdb_string corresponds to the PDB of each requested pose.
+    """
+    return self._request_pose_batch(pose_names)
 
   def request_pose_info(self,
-                        pose_name : str = None) -> Dict[str, List]:
+                        pose_name : str = None) -> Dict[str, np.ndarray]:
     """
     Specialist function to avoid dictionary lookup when requesting pose information for additional speed.
+    The pose information is requested as raw buffers if the Rosetta server supports it, falling back to json otherwise.
+    Either way it is returned as the same arrays.
 
     :param pose_name: Name of a pose stored in the Rosetta server. Pose names cannot contain spaces.
     :raises FormatError: If the Rosetta server returns an error message. This most likely means the name is not recognised.
-    :return Dict{ pose_pdb : pdb_string }: pdb_string corresponds to the PDB of the requested pose.
+    :return Dict{ atom_coords, atom_elements, atom_bonds, atom_residues }: See RequestPoseInfoBinary and normalise_pose_info.
     """
-    return RequestPoseInfo.execute(client=self._rosetta, pose_name=pose_name)
+    if self._rosetta.binary_pose_info:
+      try:
+        return RequestPoseInfoBinary.execute(client=self._rosetta, pose_name=pose_name)
+      except KeyError: # Rosetta server does not recognise the SEND_POSE_INFO_BIN key
+        self._rosetta.binary_pose_info = False
+    return normalise_pose_info(RequestPoseInfo.execute(client=self._rosetta, pose_name=pose_name))
 
   def register_rosetta_command(self,
                                ros_cmd_name : str,
                                ros_cmd : RosettaCommand,
-                               cmd_args : dict) -> None:
+                               cmd_args : dict,
+                               callback = None) -> None:
     """
     Registers a new rosetta command, ensures it maintains the correct syntax for rosetta commands.
     This enables a reference to a RosettaClient object to be added when arguments are called as they cannot be added to protobuf structs.
-    Will prepend ros_cmd_name with "ROS/" if it doesn't contain the prefix already.
+    Will prepend ros_cmd_name with "ros/" if it doesn't contain the prefix already.
+    self._ros_cmds is the single record of registered rosetta commands, the server command is always registered alongside it.
 
     :param ros_cmd_name: Name the RosettaCommand will be registered under
     :param ros_cmd: Reference to the RosettaCommand object itself.
     :param cmd_args: Dictionary of keyword argument and default values needed for the function.
+    :param callback: Function registered with the server in place of run_rosetta_command, e.g. a specialised method of this class.
     :raises ValueError: If either ros_cmd_name or ros_cmd are None
     :raises ValueError: If ros_cmd_name has already been registered
     """
@@ -176,17 +196,23 @@ class RosettaRunner:
     with self._lock:
       if not ros_cmd_name or not ros_cmd:
         raise ValueError("Rosetta Command name cannot be None.")
-      if ros_cmd_name in self._ros_cmds.keys():
-        raise ValueError("Rosetta command name already exists.")
-      if ros_cmd_name.split("/")[0] != "ros":
+      if not ros_cmd_name.startswith("ros/"):
         ros_cmd_name = "ros/" + ros_cmd_name
+      # Names are looked up on every dispatch, interning lets the lookup match on identity
+      ros_cmd_name = intern(ros_cmd_name)
+      if ros_cmd_name in self._ros_cmds:
+        raise ValueError("Rosetta command name already exists.")
 
       # Check protected arguments (client and key) haven't been used
-      if "client" in cmd_args.keys() or "key" in cmd_args.keys():
+      if "client" in cmd_args or "key" in cmd_args:
         raise KeyError("\"client\" and \"key\" are protected arguments. These cannot be used in user defined RosettaCommand.")
 
-      self._ros_cmds[ros_cmd_name] = ros_cmd.execute
-      self._server.register_command(f"{ros_cmd_name}", self.run_rosetta_command, cmd_args)
+      if callback is None:
+        callback = self.run_rosetta_command
+        cmd_args = { "ros_cmd" : ros_cmd_name, **cmd_args }
+      self._server.register_command(ros_cmd_name, callback, cmd_args)
+      # Commands are stored already bound to the client, func_signature is still available from the instance
+      self._ros_cmds = MappingProxyType({ **self._ros_cmds, ros_cmd_name : ros_cmd(self._rosetta) })
 
   def get_rosetta_command_args(self,
                                ros_cmd_name : str,
@@ -195,16 +221,15 @@ class RosettaRunner:
     Gets the keyword arguments and default value parameters used for calling the specified RosettaCommand
 
     :param ros_cmd_name: Name of the RosettaCommand as stored when the command was registered.
+    :param print_: Whether to also print the formatted signature of the command.
     :return Dict { kw_arg : arg_type, ..., return : return_type } : Dictionary of keyword arguments and return names and types.
     """
-    with self._lock:
-      if ros_cmd_name in self._ros_cmds.keys():
-        return_val = self._ros_cmds[ros_cmd_name].func_signature()
-        if print_:
-          print(return_val)
-        return return_val
-      else:
-        raise KeyError("Command not recognised")
+    command = self._ros_cmds.get(ros_cmd_name)
+    if command is None:
+      raise KeyError("Command not recognised")
+    if print_:
+      print(command.func_signature())
+    return command.func_annotations()
 
   def run_rosetta_script(self,
                          pdb : str = None,
@@ -224,9 +249,20 @@ class RosettaRunner:
       except FormatError:
         raise ValueError(f"Pdb_name {pdb_name} not recognised by Rosetta server. Request pose list to see server identifiers for poses.")
     else:
-      pdb_name = self.run_rosetta_command(ros_cmd="ros/send_pose", pose_name=pdb_name, pose_to_store=pdb)
-      pdb_name = pdb_name["pose_name"]
-      pose = self.request_pose(pdb_name)
+      pose = None
+      if self._rosetta.store_and_send_pose:
+        try:
+          # The pose is stored and sent back in a single exchange rather than a store followed by a request
+          pose = self.run_rosetta_command(ros_cmd="ros/store_and_send_pose", pose_name=pdb_name, pose_to_store=pdb)
+        except KeyError: # Rosetta server does not recognise the STORE_POSE_ECHO key
+          self._rosetta.store_and_send_pose = False
+      if pose is None:
+        pose = self.run_rosetta_command(ros_cmd="ros/send_pose", pose_name=pdb_name, pose_to_store=pdb)
+        pose.update(self.request_pose(pose["pose_name"]))
+      pdb_name = pose["pose_name"]
+
+    # The pose name is sent with every frame request of the realtime loop
+    pdb_name = intern(pdb_name)
 
     # TODO look into why num_frames is converted to float
     num_frames = int(num_frames)
@@ -252,22 +288,47 @@ class RosettaRunner:
                                    num_retries : int) -> None:
     """"""
     self._trajectory.realtime_playback()
-    self.run_rosetta_command("ros/send_and_parse_xml", pose_name=pdb_name, xml=xml)
-    num_tries = 0
-    while num_tries <= num_retries or num_retries == -1:
-      with self._lock:
-        if not self._script_in_progress:
-          break
-      try:
-        frame = self.request_pose(pdb_name)
-        self._trajectory.update_frames(frame["pose_pdb"])
+    try:
+      self.run_rosetta_command("ros/send_and_parse_xml", pose_name=pdb_name, xml=xml)
+      num_tries = 0
+      # Bound once, these are called for every frame
+      submit, collect = self._pose_requester.submit, self._pose_requester.collect
+      update_frames = self._trajectory.update_frames
+      # One pose request is always kept in flight, so Rosetta replies while the previous frame is being processed
+      request = submit(pdb_name)
+      next_request = monotonic()
+      backoff = 0.
+      # A pose Rosetta cannot send yet is never polled faster than one it can, but the backoff still grows past the interval
+      min_backoff = max(request_interval, _MIN_REQUEST_BACKOFF)
+      max_backoff = max(request_interval, _MAX_REQUEST_BACKOFF)
+      while num_tries <= num_retries or num_retries == -1:
+        with self._lock:
+          if not self._script_in_progress:
+            break
+        try:
+          frame = collect(request)
+        except (FormatError, ResponseTimeoutError):
+          # Rosetta has no pose to send yet or did not reply in time, wait increasingly long before asking again
+          # rather than polling at the frame rate
+          num_tries += 1
+          backoff = min(max(2 * backoff, min_backoff), max_backoff)
+          sleep(backoff)
+          request = submit(pdb_name)
+          next_request = monotonic()
+          continue
+        request = submit(pdb_name)
+        update_frames(frame["pose_pdb"])
         num_tries = 0
-      except FormatError:
-        num_tries += 1
-      sleep(request_interval)
-    with self._lock:
-      self._script_in_progress = False
-      self._trajectory.cancel_realtime()
+        backoff = 0.
+        # Frames are requested at a fixed rate, the time spent waiting for and processing a frame counts towards the interval.
+        # After a stall (e.g. a slow Rosetta step) the missed requests are skipped rather than sent back to back
+        now = monotonic()
+        next_request = max(next_request + request_interval, now)
+        sleep(next_request - now)
+    finally: # Always leave realtime playback, even if Rosetta could not be reached
+      with self._lock:
+        self._script_in_progress = False
+        self._trajectory.cancel_realtime()
 
   def stop_collecting_and_setup_for_xml(self) -> None:
     """"""
@@ -276,9 +337,8 @@ class RosettaRunner:
       self._trajectory.cancel_realtime()
     self._trajectory.send_current_frame()
     self._xml_builder.add_pdb(self._trajectory.get_current_frame())
-    change = DictionaryChange({ **self._xml_builder.get_residue_selector_dict(),
-                                **self._xml_builder.get_movers_dict() }, [])
-    self._server.update_state(None, change)
+    self._update_shared_state({ **self._xml_builder.get_residue_selector_dict(),
+                                **self._xml_builder.get_movers_dict() })
 
   def get_xml_and_run(self) -> None:
     xml_str = self._xml_builder.export_xml()
@@ -287,15 +347,26 @@ class RosettaRunner:
 
   def new_residue_selector(self) -> None:
     self._xml_builder.new_residue_selector()
-    selectors = self._xml_builder.get_residue_selector_dict()
-    change = DictionaryChange(selectors, [])
-    self._server.update_state(None, change)
+    self._update_shared_state(self._xml_builder.get_residue_selector_dict())
 
   def set_active_selectors(self,
                            active_selectors : dict = None) -> None:
-    selectors = self._xml_builder.set_active_residue_selectors(active_selectors)
-    change = DictionaryChange(selectors, [])
-    self._server.update_state(None, change)
+    self._update_shared_state(self._xml_builder.set_active_residue_selectors(active_selectors))
+
+  def _update_shared_state(self,
+                           updates : dict) -> None:
+    """
+    Updates the shared state dictionary with only the entries which differ from those last sent,
+    so that unchanged selectors or movers are not broadcast to every client again.
+
+    :param updates: Dictionary of shared state keys and their new values.
+    """
+    with self._lock:
+      changed = { key : value for key, value in updates.items() if self._shared_state.get(key) != value }
+      if not changed:
+        return
+      self._shared_state.update(changed)
+      self._server.update_state(None, DictionaryChange(changed, []))
 
   def close(self) -> None:
     self._renderer.close()
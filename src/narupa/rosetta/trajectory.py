@@ -1,35 +1,42 @@
 # Copyright (c) Tim Neary, University of Bristol. Github username: TENeary, contact: tn15550@bristol.ac.uk
 # Licensed under the GPL. See License.txt in the project root for license information.
 
-from concurrent import futures
 from collections import deque
-from threading import RLock
-from time import sleep
+from threading import RLock, Condition, Event, Thread
 
+from narupa.trajectory import FrameData
 from narupa.trajectory.frame_publisher import FramePublisher
-from .pdb_util import convert_pdb_string_to_framedata
+from .pdb_util import convert_pdb_string_to_framedata, convert_pdb_string_to_frame_update
 
 class RosettaTrajectoryManager:
   """
   Used for managing incoming PDBs and in progress frame viewing.
   """
+  # Attributes are read on every frame of playback, slots make these plain offset lookups
+  __slots__ = ("_frame_publisher", "_thread", "_lock", "_frame_ready", "stored_frames", "_parsed_frames", "user_fps",
+               "_new_frames", "_updated", "_stop", "_pause", "frame_id", "_topology")
+
   def __init__(self,
                frame_publisher : FramePublisher,
                stored_frames : int = 100,
                user_fps : int = 15):
     self._frame_publisher = frame_publisher
-    self._thread_pool = futures.ThreadPoolExecutor(max_workers=1)
-    self._thread = None
+    self._thread = None # Thread running the current playback loop, see _start_thread
     self._lock = RLock()
+    # Signalled when a new frame is stored or realtime playback is stopped
+    self._frame_ready = Condition(self._lock)
     self.stored_frames = deque(maxlen=stored_frames)
+    self._parsed_frames = {} # FrameData of stored frames which have been sent, see _get_framedata
     self.user_fps = user_fps
 
     # Bools for controlling the state of the TrajectoryManager
     self._new_frames = None
     self._updated = None
-    self._stop = None
-    self._pause = None
+    # Playback controls are Events, so they can be checked without the lock and stopping wakes a sleeping playback thread
+    self._stop = Event()
+    self._pause = Event()
     self.frame_id = None
+    self._topology = None # Topology of the last frame sent during realtime playback
     self._reset_bools()
 
 
@@ -37,9 +44,10 @@ class RosettaTrajectoryManager:
     with self._lock:
       self._new_frames = True
       self._updated = False
-      self._stop = False
-      self._pause = False
+      self._stop.clear()
+      self._pause.clear()
       self.frame_id = 0
+      self._topology = None
 
   @property
   def is_collecting(self) -> bool:
@@ -47,7 +55,7 @@ class RosettaTrajectoryManager:
 
   @property
   def is_playing(self) -> bool:
-    return not self._stop or not self._pause
+    return not self._stop.is_set() or not self._pause.is_set()
 
   def update_frames(self,
                     new_frame : str = None) -> None:
@@ -56,96 +64,152 @@ class RosettaTrajectoryManager:
         self.stored_frames.append(new_frame)
         self.frame_id += 1
         self._updated = True
+        self._frame_ready.notify()
 
   def clear_frames(self) -> None:
     with self._lock:
       self._new_frames = False
-      self._stop = True
-    while self._thread and not self._thread.done():
-      sleep(0.1)
+      self._stop.set()
+      self._frame_ready.notify_all()
+    if self._thread is not None:
+      self._thread.join()
     with self._lock:
       self.stored_frames.clear()
+      self._parsed_frames = {}
       self._reset_bools()
 
   def _send_last_frame(self) -> None:
     frame = None
     with self._lock:
-      if self._new_frames and self._updated:
+      # Sleeps until there is a frame to send rather than repeatedly checking for one
+      while self._new_frames and not self._updated:
+        self._frame_ready.wait()
+      if self._new_frames:
         frame = self.stored_frames[-1]
+        frame_id = self.frame_id
         self._updated = False
     if frame:
-      frame = convert_pdb_string_to_framedata(frame)
-      self._frame_publisher.send_frame(0, frame)
+      # While the topology is unchanged only the positions are sent, and merged by clients into the last full frame.
+      # A full frame is sent with index 0 so that clients replace their frame rather than merge into it.
+      frame, topology = convert_pdb_string_to_frame_update(frame, self._topology)
+      full_frame = topology is not self._topology
+      self._topology = topology
+      self._frame_publisher.send_frame(0 if full_frame else frame_id, frame)
+
+  def _get_framedata(self,
+                     pdb : str) -> FrameData:
+    """
+    Gets the FrameData of a stored frame, so that each frame is only converted once however many times it is played.
+    Frames which have dropped out of stored_frames are discarded from the cache once it reaches the same size.
+
+    :param pdb: PDB string of a stored frame.
+    :return frame: FrameData object corresponding to the given PDB.
+    """
+    frame = self._parsed_frames.get(pdb)
+    if frame is None:
+      if len(self._parsed_frames) >= len(self.stored_frames):
+        stored = set(self.stored_frames)
+        self._parsed_frames = { key : value for key, value in self._parsed_frames.items() if key in stored }
+      frame = self._parsed_frames[pdb] = convert_pdb_string_to_framedata(pdb)
+    return frame
 
   def _realtime_playback(self) -> None:
     while self._new_frames:
       self._send_last_frame()
 
   def realtime_playback(self) -> None:
-    if self._thread:
-      if self._thread.done():
-        self._reset_bools()
-        self._thread = self._thread_pool.submit(self._realtime_playback)
-    else:
+    if not self._is_running():
       self._reset_bools()
-      self._thread = self._thread_pool.submit(self._realtime_playback)
+      self._start_thread(self._realtime_playback)
 
   def cancel_realtime(self) -> None:
     with self._lock:
       self._new_frames = False
-      self._stop = True
+      self._stop.set()
+      self._frame_ready.notify_all()
 
   ################################################################
   ################### For playing saved frames ###################
   ################################################################
 
   def step(self) -> None:
-    self._frame_publisher.send_frame( self.frame_id, self.stored_frames[self.frame_id] )
-    self.frame_id = ( self.frame_id + 1) % len(self.stored_frames)
+    self._step( self.stored_frames )
+
+  def _step(self,
+            frames) -> None:
+    """
+    Sends the frame indicated by frame_id from the given frames and moves on to the next, wrapping around at the end.
+    """
+    if not frames:
+      return
+    frame_id = self._current_index(frames)
+    self._frame_publisher.send_frame( frame_id, self._get_framedata(frames[frame_id]) )
+    self.frame_id = ( frame_id + 1) % len(frames)
 
   def reset(self) -> None:
     with self._lock:
       self.frame_id = 0
 
-  def _play(self) -> None:
-    if self.stored_frames and not self._new_frames:
-      while not self._stop:
-        if not self._pause:
-          self.step()
-        sleep(1 / self.user_fps)
+  def _play(self,
+            frames : tuple) -> None:
+    if frames and not self._new_frames:
+      interval = 1 / self.user_fps
+      while not self._stop.is_set():
+        if not self._pause.is_set():
+          self._step(frames)
+        if self._stop.wait(interval):
+          break
 
   def play_saved(self) -> None:
+    self._stop.clear()
+    self._pause.clear()
     with self._lock:
-      self._stop = False
-      self._pause = False
-    if self._thread:
-      if self._thread.done():
-        self._thread = self._thread_pool.submit(self._play)
-    else:
-      self._thread = self._thread_pool.submit(self._play)
+      # Saved frames are not added to during playback, so they are played from a snapshot without taking the lock
+      frames = tuple(self.stored_frames)
+    if not self._is_running():
+      self._start_thread(self._play, frames)
 
   def cancel(self) -> None:
-    with self._lock:
-      self._stop = True
+    self._stop.set()
 
   def pause(self) -> None:
-    with self._lock:
-      self._pause = True
+    self._pause.set()
 
   ################################################################
   #####################  Utility functions   #####################
   ################################################################
 
+  def _is_running(self) -> bool:
+    return self._thread is not None and self._thread.is_alive()
+
+  def _start_thread(self,
+                    target,
+                    *args) -> None:
+    """
+    Runs a playback loop on its own daemon thread. Only one loop runs at a time, so no pool is needed,
+    and a loop left running does not hold up interpreter exit.
+    """
+    self._thread = Thread(target=target, args=args, daemon=True)
+    self._thread.start()
+
+  def _current_index(self,
+                     frames) -> int:
+    """
+    Gets the index of the frame indicated by frame_id within the given frames.
+    frame_id counts every frame received during realtime playback, so once older frames have dropped out of
+    stored_frames it is past the end, in which case the current frame is the latest one.
+    """
+    return self.frame_id if self.frame_id < len(frames) else len(frames) - 1
+
   def get_current_frame(self) -> str:
     """
     Gets the pdb of the frame as indicated by the current frame_id.
 
     :return pdb_string: String corresponding to the pdb of the current frame.
     """
-    return self.stored_frames[self.frame_id]
+    return self.stored_frames[self._current_index(self.stored_frames)]
 
   def send_current_frame(self) -> None:
     if self.stored_frames:
-      frame = self.stored_frames[self.frame_id]
-    frame = convert_pdb_string_to_framedata(frame)
-    self._frame_publisher.send_frame(0, frame)
\ No newline at end of file
+      frame = self._get_framedata(self.stored_frames[self._current_index(self.stored_frames)])
+      self._frame_publisher.send_frame(0, frame)
\ No newline at end of file
@@ -4,7 +4,8 @@
 import xml.etree.ElementTree as xml
 import numpy as np
 from concurrent import futures
-from threading import RLock
+from threading import RLock, Lock
+from typing import Tuple
 
 from narupa.app import NarupaImdClient
 from narupa.state.state_service import DictionaryChange
@@ -30,6 +31,16 @@ MOVERS = "MOVERS"
 PROTOCOLS = "PROTOCOLS"
 OUTPUT = "OUTPUT" # Technically should be obsolete in RosettaScripts now
 
+# Attributes each mover type is added with, other than its name and task operations, see RosettaScriptsBuilder._add_mover
+_MOVER_DEFAULTS = { "PackRotamersMover" : {},
+                    "MinMover" : { "chi" : "true",
+                                   "bb" : "true",
+                                   "jump" : "0",
+                                   "tolerance" : "0.1",
+                                   "max_iter" : "1000" },
+                    "FastDesign" : {}, # e.g. "scorefxn", "cst_file"
+                    "FastRelax" : {} }
+
 class RosettaScriptsBuilder:
   """
   Takes selections from Narupa to build Rosetta scripts.
@@ -37,12 +48,19 @@ class RosettaScriptsBuilder:
   """
   def __init__(self,
                pdb : str = None,
-               delimiter : str = None,
+               delimiter : str = "\n",
                pdb_list : list = None,
                renderer : NarupaImdClient = None):
     """"""
     self._thread_pool = futures.ThreadPoolExecutor(max_workers=1)
+    # Separate locks for the residue selectors (and pdb), the XML script and the renderer update flags, so that e.g.
+    # interaction updates are not held up by an XML export. Where both are needed _selection_lock is taken first.
     self._selection_lock = RLock()
+    self._xml_lock = RLock()
+    self._renderer_lock = Lock()
+    # Renderer updates are coalesced, see _queue_renderer_update
+    self._renderer_update_pending = False
+    self._renderer_update_global = False
 
     if renderer:
       self._renderer = renderer
@@ -52,11 +70,19 @@ class RosettaScriptsBuilder:
       raise ValueError( "renderer cannot be None" )
 
     self.residue_selectors = []
-    self._active_residue_selectors = []
+    self._active_residue_selectors = set() # Names of the active residue selectors
+    self._residue_selector_dict = None # Cleared whenever the selectors change, see get_residue_selector_dict
     self._add_res_to_sele = True
 
     self._pdb = None
-    self._pdb_info = None # [ atom_id, res_id, res_name ]
+    self._pdb_info = None # Structured array with fields atom_id, res_id, res_name
+    self._pdb_res_ids = None # res_id and zero indexed atom_id of _pdb_info as ints, see add_pdb
+    self._pdb_atom_ids = None
+    self._pdb_residues = None # Sorted unique residue ids of the pdb, used to invert selections
+    self._rendered_particles = None # Active particles last sent to the renderer, see update_renderer
+    self._combined_residues = None # Residues of the last combined selector, see _create_combined_residue_selector
+    self._mover_residues = None # Residues outside the last combined selector, see _get_mover_residue_selector
+    self._parsed_pdb = None # Last pdb string given to add_pdb and what was parsed from it, kept through clear
     self.add_pdb(pdb, delimiter, pdb_list)
 
     self._available_movers = { "FastDesign" : self.add_fastdesign_mover,
@@ -64,6 +90,8 @@ class RosettaScriptsBuilder:
                                "PackRotamers" : self.add_pack_mover,
                                "Minimise" : self.add_minimise_mover }
     # TODO move mover constructor as objects
+    # The available movers are fixed, so the shared state entry listing them only needs building once
+    self._movers_dict = { SHARED_DICT_KEY_MOVER : [ [mover, False] for mover in self._available_movers ] }
 
 
   def add_pdb(self,
@@ -72,31 +100,43 @@ class RosettaScriptsBuilder:
               pdb_list : list = None) -> None:
     with self._selection_lock:
       self.clear()
-      if pdb:
+      cached = self._parsed_pdb
+      if pdb and cached is not None and cached[:2] == (pdb, delimiter):
+        # The same pdb is often added again, e.g. resending the current frame, so is not parsed twice
+        self._pdb, self._pdb_info, self._pdb_res_ids, self._pdb_atom_ids, self._pdb_residues = cached[2:]
+      elif pdb:
         self._pdb = pdb.split(delimiter)
       elif pdb_list:
         self._pdb = pdb_list
       else:
         self._pdb = None
       if self._pdb is not None:
-        self._pdb_info = get_residues_from_pdb_list(self._pdb)
-        self.residue_selectors = [ResidueSelector(name="Whole Protein", sele_type="Index", res_list=self._pdb_info[:, 1])]
-        self._thread_pool.submit(self.update_renderer, True)
+        if self._pdb_info is None:
+          self._pdb_info = get_residues_from_pdb_list(self._pdb)
+          # Converted once here rather than each time the active particles are found
+          self._pdb_res_ids = self._pdb_info["res_id"].astype(np.int32)
+          self._pdb_atom_ids = self._pdb_info["atom_id"].astype(np.int32) - 1
+          self._pdb_residues = np.unique(self._pdb_res_ids)
+          self._pdb_residues.flags.writeable = False
+          if pdb:
+            self._parsed_pdb = (pdb, delimiter, self._pdb, self._pdb_info, self._pdb_res_ids, self._pdb_atom_ids, self._pdb_residues)
+        whole_protein = ResidueSelector(name="Whole Protein", sele_type="Index")
+        # Selectors replace rather than modify their residues, so the pdb's unique residues can be shared
+        whole_protein.residues = self._pdb_residues
+        self.residue_selectors = [whole_protein]
+        self._residue_selector_dict = None
+        self._queue_renderer_update(True)
 
   def _build_default_rosetta_script(self) -> None:
     """
     Builds default RosettaScript XML format.
     It will be assumed that each first level SubElement is never duplicated.
     """
-    self._xml = xml.Element(ROSETTASCRIPTS)
-    self._xml.append(xml.Element(SCOREFXNS))
-    self._xml.append(xml.Element(RESIDUE_SELECTORS))
-    self._xml.append(xml.Element(TASKOPERATIONS))
-    self._xml.append(xml.Element(SIMPLE_METRICS))
-    self._xml.append(xml.Element(FILTERS))
-    self._xml.append(xml.Element(MOVERS))
-    self._xml.append(xml.Element(PROTOCOLS))
-    self._xml.append(xml.Element(OUTPUT))
+    with self._xml_lock:
+      self._xml = xml.Element(ROSETTASCRIPTS)
+      for field in (SCOREFXNS, RESIDUE_SELECTORS, TASKOPERATIONS, SIMPLE_METRICS, FILTERS, MOVERS, PROTOCOLS, OUTPUT):
+        xml.SubElement(self._xml, field)
+      self._index_fields()
 
   def import_xml_from_string(self,
                              xml_str : str) -> None:
@@ -104,7 +144,47 @@ class RosettaScriptsBuilder:
     Sets the current XML script to be the xml provided.
     TODO do basic error checking to ensure it matches the standard ROSETTASCRIPT format
     """
-    self._xml = xml.fromstring(xml_str)
+    xml_root = xml.fromstring(xml_str)
+    with self._xml_lock:
+      self._xml = xml_root
+      self._index_fields()
+
+  def _index_fields(self) -> None:
+    """
+    Indexes the first level fields by tag, and the names of their entries by entry type, so that neither requires
+    scanning the XML. Entries should then only be added with _add_entry to keep the index up to date.
+    """
+    self._fields = { field.tag : field for field in self._xml }
+    self._exported_xml = None # Cleared whenever the XML changes, see export_xml
+    self._entry_names = {}
+    for field in self._xml:
+      entry_names = self._entry_names[field.tag] = {}
+      for entry in field:
+        entry_names.setdefault(entry.tag, set()).add(entry.get("name"))
+
+  def _add_entry(self,
+                 first_level_field : str,
+                 entry : xml.Element) -> None:
+    """
+    Appends the entry to the given first level field and records its name, see _index_fields.
+    """
+    with self._xml_lock:
+      self._fields[first_level_field].append(entry)
+      self._exported_xml = None
+      self._entry_names[first_level_field].setdefault(entry.tag, set()).add(entry.get("name"))
+
+  def _add_new_entry(self,
+                     first_level_field : str,
+                     entry_type : str,
+                     attrib : dict) -> xml.Element:
+    """
+    As _add_entry, but creates the entry directly within the first level field with xml.SubElement.
+    """
+    with self._xml_lock:
+      entry = xml.SubElement(self._fields[first_level_field], entry_type, attrib)
+      self._exported_xml = None
+      self._entry_names[first_level_field].setdefault(entry_type, set()).add(attrib.get("name"))
+    return entry
 
   def rebuild_xml(self) -> None:
     """
@@ -116,45 +196,48 @@ class RosettaScriptsBuilder:
     """
     Clears all stored information, including pdb, xml, atom and residue information.
     """
-    self._pdb = None
-    self._pdb_info = None
-    self._build_default_rosetta_script()
-    self._active_residue_selectors = []
+    with self._selection_lock:
+      self._pdb = None
+      self._pdb_info = None
+      self._pdb_res_ids = None
+      self._pdb_atom_ids = None
+      self._pdb_residues = None
+      self._rendered_particles = None
+      self._build_default_rosetta_script()
+      self._active_residue_selectors = set()
+      self._residue_selector_dict = None
 
   def get_residue_selector_dict(self) -> dict:
-    """"""
-    shared_dict_key = { SHARED_DICT_KEY_RES_SELE : [] }
+    """
+    Gets the shared state entry listing each residue selector and whether it is active.
+    The dict is rebuilt only after the selectors change and is shared between callers, so should not be modified.
+    """
     with self._selection_lock:
-      for res_sele in self.residue_selectors:
-        if res_sele.name in self._active_residue_selectors:
-          active = True
-        else:
-          active = False
-        shared_dict_key[SHARED_DICT_KEY_RES_SELE].append([res_sele.name, active])
-    return shared_dict_key
+      if self._residue_selector_dict is None:
+        self._residue_selector_dict = { SHARED_DICT_KEY_RES_SELE : [ [res_sele.name, res_sele.name in self._active_residue_selectors]
+                                                                     for res_sele in self.residue_selectors ] }
+      return self._residue_selector_dict
 
   def get_movers_dict(self) -> dict:
-    """"""
-    shared_dict_key = { SHARED_DICT_KEY_MOVER : [] }
-    with self._selection_lock:
-      for mover in self._available_movers.keys():
-        shared_dict_key[SHARED_DICT_KEY_MOVER].append([mover, False])
-    return shared_dict_key
+    """
+    Gets the shared state entry listing the available movers, built once on construction and shared between callers.
+    """
+    return self._movers_dict
 
   def new_residue_selector(self) -> None:
     with self._selection_lock:
       self.residue_selectors.append(ResidueSelector(name="selector" + str(len(self.residue_selectors)), sele_type="Index"))
+      self._residue_selector_dict = None
 
   def _entry_exists(self,
                     entry_name : str,
                     entry_type : str,
                     first_level_field : str) -> bool:
     """"""
-    try:
-      selectors = list(self._xml.find(first_level_field).findall(entry_type))
-    except:
+    entry_names = self._entry_names.get(first_level_field)
+    if entry_names is None:
       raise KeyError( f"Given keys do not exist: Could not find {first_level_field} in top levels fields or {entry_type} in sub-fields.")
-    return any([ele.get("name") == entry_name for ele in selectors])
+    return entry_name in entry_names.get(entry_type, ())
 
   def _get_unique_name(self,
                        first_level_field : str,
@@ -168,7 +251,12 @@ class RosettaScriptsBuilder:
 
     if not curr_name or self._entry_exists(curr_name, entry_type, first_level_field):
       new_name += first_level_field.lower()
-      new_name += str(len(list(self._xml.find(first_level_field))))
+      # Numbered from the field's size, which is O(1) and already unique unless e.g. an imported entry has the name
+      count = len(self._fields[first_level_field])
+      field_names = self._entry_names[first_level_field].values()
+      while any(new_name + str(count) in names for names in field_names):
+        count += 1
+      new_name += str(count)
     else:
       new_name += curr_name
 
@@ -189,52 +277,103 @@ class RosettaScriptsBuilder:
         raise ValueError(f"Only non-empty ({not residue_selector.is_empty}) residue selectors of type {residue_selector.type} should be added with this method.")
     else:
       selector = ResidueSelector(name=selector_name, sele_type="Index", res_list=atom_selections)
-    self._xml.find(RESIDUE_SELECTORS).append(selector.to_xml())
+    self._add_entry(RESIDUE_SELECTORS, selector.to_xml())
     return selector_name
 
   def _get_all_active_particles(self) -> np.array:
     """"""
-    if self._pdb is None:
-      return np.array([], dtype=int)
-    all_res = np.array([], dtype=int)
     with self._selection_lock:
+      if self._pdb is None or not len(self._pdb_res_ids):
+        return np.array([], dtype=np.int32)
+      # Residues of every active selector are marked in a single mask indexed by residue id, which then selects the atoms
+      res_ids = self._pdb_res_ids
+      first_res = res_ids.min()
+      is_active = np.zeros(res_ids.max() - first_res + 1, dtype=bool)
       for sele in self.residue_selectors:
         if sele.name in self._active_residue_selectors:
-          all_res = np.concatenate((all_res, sele.residues))
-      all_particles = self._pdb_info[np.isin(self._pdb_info[:, 1].astype(int), all_res), 0].astype(int) - 1
-    return all_particles
+          residues = sele.residues - first_res
+          is_active[residues[(residues >= 0) & (residues < len(is_active))]] = True
+      return self._pdb_atom_ids[is_active[res_ids - first_res]]
 
   def update_renderer(self,
                       update_global : bool = False) -> None:
     """"""
-    active_particles = map(int, self._get_all_active_particles())
+    active_particles = self._get_all_active_particles()
     if update_global:
+      # modify() flushes the changes to the server when the block exits, so no further flush is needed
       with self.root_selection.modify() as root:
         root.renderer = { "color" : "cpk",
                           "render" : "ball and stick" }
-      self.root_selection.flush_changes()
-    # if not np.isin( active_particles, self.active_selection.selected_particle_ids ).any():
+    # The active selection is only resent when its particles have changed, e.g. not when an already selected residue is added
+    if self._rendered_particles is not None and np.array_equal(active_particles, self._rendered_particles):
+      return
+    self._rendered_particles = active_particles
     with self.active_selection.modify() as selection:
-      selection.set_particles(active_particles)
+      # The selection is serialised as Python ints, tolist converts them all at once in C
+      selection.set_particles(active_particles.tolist())
       selection.renderer = { "color" : "Green",
                              "render" : "ball and stick" }
-    self.active_selection.flush_changes()
+
+  def _queue_renderer_update(self,
+                             update_global : bool = False) -> None:
+    """
+    Queues a renderer update, unless one is already waiting to run in which case the request is merged into it.
+    Rapid selection changes (e.g. from a VR interaction) then result in a single update rather than one per change.
+
+    :param update_global: Whether the root selection should also be updated.
+    """
+    with self._renderer_lock:
+      self._renderer_update_global = self._renderer_update_global or update_global
+      if self._renderer_update_pending:
+        return
+      self._renderer_update_pending = True
+    self._thread_pool.submit(self._flush_renderer_update)
+
+  def _flush_renderer_update(self) -> None:
+    """"""
+    # Flags are cleared before updating so changes made during the update queue another one
+    with self._renderer_lock:
+      update_global = self._renderer_update_global
+      self._renderer_update_pending = False
+      self._renderer_update_global = False
+    self.update_renderer(update_global)
 
   def add_new_res(self,
                   particles : list) -> None:
     """"""
+    atom_ids, new_res = self._get_particle_residues(particles)
     with self._selection_lock:
+      if atom_ids is not self._pdb_atom_ids: # The pdb changed while the residues were found
+        return
       for res_sele in self.residue_selectors:
         if res_sele.name in self._active_residue_selectors:
-          res_sele.add_residues(self._pdb_info, np.asarray(particles, dtype=int))
+          res_sele.add_residue_ids(new_res)
 
   def rm_new_res(self,
                  particles : list) -> None:
     """"""
+    atom_ids, old_res = self._get_particle_residues(particles)
     with self._selection_lock:
+      if atom_ids is not self._pdb_atom_ids:
+        return
       for res_sele in self.residue_selectors:
         if res_sele.name in self._active_residue_selectors:
-          res_sele.remove_residues(self._pdb_info, np.asarray(particles, dtype=int))
+          res_sele.remove_residue_ids(old_res)
+
+  def _get_particle_residues(self,
+                             particles : list) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gets the sorted, unique residue ids of the given particles. Found once for all active selectors rather than by each.
+    Particles are zero indexed, as the atom ids used for the active selection in _get_all_active_particles.
+    Only the references to the pdb arrays are taken under the selection lock. add_pdb replaces rather than modifies
+    the arrays, so the lookup itself is done outside it and the atom ids used are returned for callers to check the pdb
+    is unchanged.
+    """
+    with self._selection_lock:
+      res_ids, atom_ids = self._pdb_res_ids, self._pdb_atom_ids
+    if atom_ids is None:
+      return atom_ids, np.array([], dtype=np.int32)
+    return atom_ids, np.unique(res_ids[np.isin(atom_ids, np.asarray(particles, dtype=np.int32))])
 
   def new_residues(self,
                    access_token,
@@ -248,12 +387,11 @@ class RosettaScriptsBuilder:
         all_particles.extend(item["particles"])
     if not all_particles:
       return
-    with self._selection_lock:
-      if self._add_res_to_sele:
-        self.add_new_res(all_particles)
-      else:
-        self.rm_new_res(all_particles)
-    self._thread_pool.submit(self.update_renderer, True)
+    if self._add_res_to_sele:
+      self.add_new_res(all_particles)
+    else:
+      self.rm_new_res(all_particles)
+    self._queue_renderer_update(True)
 
   def set_add_new_res(self) -> None:
     """"""
@@ -266,15 +404,13 @@ class RosettaScriptsBuilder:
   def set_active_residue_selectors(self,
                                    active_selectors : dict = None) -> dict:
     """"""
-    self._active_residue_selectors = []
     with self._selection_lock:
       if active_selectors is None:
-        pass
+        self._active_residue_selectors = set()
       else:
-        for selector, active in active_selectors.items():
-          if active:
-            self._active_residue_selectors.append(selector)
-    self._thread_pool.submit(self.update_renderer, False)
+        self._active_residue_selectors = { selector for selector, active in active_selectors.items() if active }
+      self._residue_selector_dict = None
+    self._queue_renderer_update(False)
     return self.get_residue_selector_dict()
 
   def _create_combined_residue_selector(self,
@@ -282,13 +418,39 @@ class RosettaScriptsBuilder:
                                         sele_type : str = "Index") -> ResidueSelector:
     """"""
     comb_sele_name = self._get_unique_name(RESIDUE_SELECTORS, sele_type, prefix="comb_")
-    all_res = np.array([], dtype=int)
-    for sele in self.residue_selectors:
-      if sele.name in residue_selectors:
-        all_res = np.concatenate((all_res, sele.residues))
-    comb_selector = ResidueSelector(comb_sele_name, sele_type, res_list=all_res)
+    sele_residues = [ sele.residues for sele in self.residue_selectors if sele.name in residue_selectors ]
+    # Selectors replace their residue arrays rather than modifying them, so while the same arrays are combined
+    # (e.g. when several movers are added for the same selection) the previous union is reused
+    cached = self._combined_residues
+    if cached is None or len(cached[0]) != len(sele_residues) or any(old is not new for old, new in zip(cached[0], sele_residues)):
+      if len(sele_residues) == 1:
+        # Selector residues are already sorted and unique, a read only view avoids copying and re-sorting them
+        all_res = sele_residues[0].view()
+      elif sele_residues:
+        all_res = np.unique(np.concatenate(sele_residues))
+      else:
+        all_res = np.array([], dtype=np.int32)
+      all_res.flags.writeable = False
+      self._combined_residues = cached = (sele_residues, all_res)
+    comb_selector = ResidueSelector(comb_sele_name, sele_type)
+    comb_selector.residues = cached[1]
     return comb_selector
 
+  def _get_mover_residue_selector(self,
+                                  residue_selectors : list) -> ResidueSelector:
+    """
+    Combines the residue selectors and inverts the result within the pdb, giving the residues a mover should not change.
+    While the combined residues are unchanged, e.g. when several movers are added together, the inversion is reused.
+    """
+    comb_sele = self._create_combined_residue_selector(residue_selectors)
+    cached = self._mover_residues
+    if cached is None or cached[0] is not comb_sele.residues or cached[1] is not self._pdb_residues:
+      inverted = comb_sele.invert_within(self._pdb_residues).residues
+      inverted.flags.writeable = False
+      self._mover_residues = cached = (comb_sele.residues, self._pdb_residues, inverted)
+    comb_sele.residues = cached[2]
+    return comb_sele
+
   def add_task_operation(self,
                          residue_selectors : list,
                          invert_selection : bool = False,
@@ -296,7 +458,7 @@ class RosettaScriptsBuilder:
     res_sele_names = []
     for res_sele in residue_selectors:
       if invert_selection:
-        res_sele = res_sele.invert(self._pdb_info)
+        res_sele = res_sele.invert_within(self._pdb_residues)
       res_sele_names.append(self.add_index_residue_selector(residue_selector=res_sele))
 
     task_operation_name = self._get_unique_name(TASKOPERATIONS, DEFAULT_TASK_OPERATION)
@@ -304,99 +466,56 @@ class RosettaScriptsBuilder:
                                  name=task_operation_name,
                                  selector=",".join(res_sele_names),
                                  )
-    if prevent_design:
-      task_operation.append(xml.Element(PREVENT_DESIGN))
-    else:
-      task_operation.append(xml.Element(PREVENT_REPACK))
-    self._xml.find(TASKOPERATIONS).append(task_operation)
+    xml.SubElement(task_operation, PREVENT_DESIGN if prevent_design else PREVENT_REPACK)
+    self._add_entry(TASKOPERATIONS, task_operation)
     return task_operation_name
 
+  def _add_mover(self,
+                 mover_type : str,
+                 mover_name : str = None,
+                 residue_selectors : list = None,
+                 use_selection : bool = True) -> xml.Element:
+    """
+    Adds a mover of the given type with its attributes from _MOVER_DEFAULTS. If use_selection, the mover is restricted
+    to the combined residue selectors (or the active selectors if none are given) by a task operation.
+    """
+    mover_name = self._get_unique_name(MOVERS, mover_type, mover_name)
+    mover_dict = { "name" : mover_name }
+    mover_dict.update(_MOVER_DEFAULTS[mover_type])
+    if use_selection:
+      if not residue_selectors:
+        residue_selectors = self._active_residue_selectors
+      comb_res_sele = self._get_mover_residue_selector(residue_selectors)
+      if not comb_res_sele.is_empty:
+        mover_dict["task_operations"] = self.add_task_operation([comb_res_sele], invert_selection=False, prevent_design=False)
+    return self._add_new_entry(MOVERS, mover_type, mover_dict)
+
   def add_pack_mover(self, # TODO implement way to add all available args to RosettaScripts
                      mover_name : str = None,
                      residue_selectors: list = None,
                      task_operations : str = None) -> str:
     """"""
-    mover_type  = "PackRotamersMover"
-    mover_name = self._get_unique_name(MOVERS, mover_type, mover_name)
-    if not residue_selectors:
-      residue_selectors = self._active_residue_selectors
-    comb_res_sele = self._create_combined_residue_selector(residue_selectors).invert(self._pdb_info)
-
-    mover_dict = { "name" : mover_name,
-                   }
-    if not comb_res_sele.is_empty:
-      task_operation_name = self.add_task_operation([comb_res_sele], invert_selection=False, prevent_design=False)
-      mover_dict.update({ "task_operations" : task_operation_name,
-                          })
-
-    mover = xml.Element(mover_type,
-                        **mover_dict)
-    self._xml.find(MOVERS).append(mover)
-    return mover_name
+    return self._add_mover("PackRotamersMover", mover_name, residue_selectors).get("name")
 
   def add_minimise_mover(self,
                          residue_selectors: list = None,
                          mover_name : str = None) -> xml.Element: # TODO currently cannot be controlled with selections implement movemap factory builder
     """"""
-    mover_type = "MinMover"
-    mover_name = self._get_unique_name(MOVERS, mover_type, mover_name)
-    mover = xml.Element(mover_type,
-                        name=mover_name,
-                        chi="true",
-                        bb="true",
-                        jump="0",
-                        tolerance="0.1",
-                        max_iter="1000")
-    self._xml.find(MOVERS).append(mover)
-    return mover
+    return self._add_mover("MinMover", mover_name, use_selection=False)
 
   def add_fastdesign_mover(self,
                            mover_name : str = None,
                            residue_selectors : list = None,
                            task_operations : list = None) -> xml.Element:
     """"""
-    mover_type = "FastDesign"
-    mover_name = self._get_unique_name(MOVERS, mover_type, mover_name)
-    if not residue_selectors:
-      residue_selectors = self._active_residue_selectors
-    comb_res_sele = self._create_combined_residue_selector(residue_selectors).invert(self._pdb_info)
-    mover_dict = { "name" : mover_name,
-                   # "scorefxn" : "",
-                   # "cst_file" : "",
-                   }
-    if not comb_res_sele.is_empty:
-      task_operation_name = self.add_task_operation([comb_res_sele], invert_selection=False, prevent_design=False)
-      mover_dict.update({ "task_operations" : task_operation_name,
-                          })
-
-    mover = xml.Element(mover_type,
-                        **mover_dict)
-    self._xml.find(MOVERS).append(mover)
-    return mover
+    return self._add_mover("FastDesign", mover_name, residue_selectors)
 
   def add_fastrelax_mover(self,
                           mover_name : str = None,
                           residue_selectors : list = None,
                           task_operations : list = None) -> xml.Element:
     """"""
-    mover_type = "FastDesign"
-    mover_name = self._get_unique_name(MOVERS, mover_type, mover_name)
-    if not residue_selectors:
-      residue_selectors = self._active_residue_selectors
-    comb_res_sele = self._create_combined_residue_selector(residue_selectors).invert(self._pdb_info)
-    mover_dict = { "name" : mover_name,
-                   # "scorefxn" : "",
-                   # "cst_file" : "",
-                   }
-    if not comb_res_sele.is_empty:
-      task_operation_name = self.add_task_operation([comb_res_sele], invert_selection=False, prevent_design=False)
-      mover_dict.update({ "task_operations" : task_operation_name,
-                          })
-
-    mover = xml.Element(mover_type,
-                        **mover_dict)
-    self._xml.find(MOVERS).append(mover)
-    return mover
+    return self._add_mover("FastRelax", mover_name, residue_selectors)
 
   def add_new_movers(self,
                      selected_movers : dict = None,
@@ -405,31 +524,34 @@ class RosettaScriptsBuilder:
     # Currently all movers' names will be auto generated and use the active residue selectors
     if selected_movers is None or selected_movers == {}:
       return
-    for mover, selected in selected_movers.items():
-      if selected and mover in self._available_movers:
-        with self._selection_lock:
+    # Movers combine the residue selectors into the XML, so need both locks. These are held for the whole batch so
+    # that the movers share the combined residues and the script is never exported with only some of them added
+    with self._selection_lock, self._xml_lock:
+      for mover, selected in selected_movers.items():
+        if selected and mover in self._available_movers:
           self._available_movers[mover](residue_selectors=residue_selectors)
 
   def _finalise_xml(self) -> None:
     # TODO implement checks that all referenced residue selectors/task operations are included
     mov_names = []
-    proto_names = self._xml.find(PROTOCOLS)
-    for mov in self._xml.find(MOVERS):
-      if mov.attrib["name"]:
-        mov_names.append(mov.attrib["name"])
+    for mov in self._fields[MOVERS]:
+      if mov.get("name"):
+        mov_names.append(mov.get("name"))
       else:
         raise KeyError(f"Mover {mov.tag} does not have required field \"name\"")
-    for proto in self._xml.find(PROTOCOLS):
-      if proto.attrib["mover_name"]:
-        proto_names.append(proto.attrib["mover_name"])
+    proto_names = { proto.get("mover_name") for proto in self._fields[PROTOCOLS] }
 
+    # Each mover without a protocol entry is added once, in the order the movers were added
     for mov in mov_names:
-      if not mov in proto_names:
-        proto_ele = xml.Element("Add",
-                                mover_name=mov)
-        self._xml.find(PROTOCOLS).append(proto_ele)
+      if mov not in proto_names:
+        xml.SubElement(self._fields[PROTOCOLS], "Add", mover_name=mov)
+        proto_names.add(mov)
 
   def export_xml(self) -> str:
     """"""
-    self._finalise_xml()
-    return xml.tostring(self._xml, encoding="utf-8").decode() # As to string gives a bytearray
\ No newline at end of file
+    # The script is only finalised and serialised again once it has changed
+    with self._xml_lock:
+      if self._exported_xml is None:
+        self._finalise_xml()
+        self._exported_xml = xml.tostring(self._xml, encoding="utf-8").decode() # As to string gives a bytearray
+      return self._exported_xml
\ No newline at end of file